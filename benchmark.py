@@ -0,0 +1,492 @@
+"""Concurrent-session load generator and latency benchmark for the local guide.
+
+Drives the LocalGuide core the same way main() does, with many simulated
+sessions replaying scripted conversations against local stand-ins for Google
+Maps and OpenAI with configurable latency.
+
+    python benchmark.py --sessions 50 --maps-latency 0.08 --llm-latency 0.6
+    python benchmark.py --sessions 500 --concurrency 100 --compare bench_results/previous.json
+    python benchmark.py --cache fakeredis:// --workers 4
+"""
+
+import argparse
+import contextvars
+import hashlib
+import json
+import os
+import random
+import resource
+import statistics
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Dict, List
+
+import local_guide as lg
+
+RESULTS_DIR = "bench_results"
+PROMPT_CACHE_MIN_TOKENS = 1024  # Shortest prefix the provider caches
+PROMPT_CACHE_STEP_TOKENS = 128  # Cached prefixes grow in steps of this size
+
+# Scripted conversations: (flow, payload) steps replayed by each session
+SCRIPTS = [
+    [
+        ("suggestion", "Best breakfast spots nearby?"),
+        ("location_query", "Any good sushi restaurants near the river?"),
+        ("location_query", "Sushi first, then a cocktail bar nearby?"),
+        ("chat", "How do I get around without a car?"),
+        ("replay", None),
+        ("recommendations", "food"),
+        ("itinerary", None),
+    ],
+    [
+        ("suggestion", "Family-friendly attractions?"),
+        ("location_query", "Where is the best museum around here?"),
+        ("location_query", "Find a park close by for a picnic"),
+        ("replay", None),
+        ("recommendations", "activities"),
+        ("recommendations", "general"),
+    ],
+    [
+        ("suggestion", "Bars with live music?"),
+        ("location_query", "Recommend a romantic dinner restaurant, budget friendly"),
+        ("chat", "What's the weather usually like in spring?"),
+        ("itinerary", None),
+    ],
+]
+
+LOCATIONS = [
+    lg.Location("London, UK"),
+    lg.Location("Paris, France"),
+    lg.Location("Tokyo, Japan"),
+    # Sessions that shared their browser location
+    lg.Location("Westminster, London SW1A 0AA, UK", 51.5007, -0.1246),
+    lg.Location("Shibuya City, Tokyo, Japan", 35.6595, 139.7005),
+]
+
+
+class CallCounter:
+    """Thread-safe counter of external calls per API, also attributed to the calling turn.
+
+    The turn is tracked in a context variable, so searches that find_places fans
+    out to its pool still count towards the turn; prefetch workers start with an
+    empty context and count as background.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._turn = contextvars.ContextVar("turn_calls", default=None)
+        self.counts = defaultdict(int)
+        self.background = 0
+
+    def hit(self, name: str) -> None:
+        turn = self._turn.get()
+        with self._lock:
+            self.counts[name] += 1
+            if turn is None:
+                self.background += 1
+            else:
+                turn[0] += 1
+
+    def begin_turn(self) -> None:
+        self._turn.set([0])
+
+    def end_turn(self) -> int:
+        turn = self._turn.get()
+        self._turn.set(None)
+        return turn[0]
+
+    def total(self) -> int:
+        with self._lock:
+            return sum(self.counts.values())
+
+
+class FakeMapsClient:
+    """Stand-in for googlemaps.Client with a fixed per-call latency"""
+
+    def __init__(self, latency: float, counter: CallCounter):
+        self.latency = latency
+        self.counter = counter
+
+    def _call(self, name: str) -> None:
+        self.counter.hit(f"maps.{name}")
+        time.sleep(self.latency)
+
+    def geocode(self, address):
+        self._call("geocode")
+        rng = random.Random(address)
+        return [{"geometry": {"location": {"lat": rng.uniform(-60, 60), "lng": rng.uniform(-180, 180)}},
+                 "formatted_address": address}]
+
+    def reverse_geocode(self, latlng):
+        self._call("reverse_geocode")
+        return [{"formatted_address": f"{latlng[0]:.4f}, {latlng[1]:.4f}"}]
+
+    def places_nearby(self, location=None, radius=None, keyword=None, open_now=None, **kwargs):
+        self._call("places_nearby")
+        rng = random.Random(f"{location}-{keyword}")
+        lat, lng = location["lat"], location["lng"]
+        results = []
+        for i in range(12):
+            results.append({
+                "name": f"{str(keyword).title()} Place {i}",
+                "rating": round(rng.uniform(3.0, 5.0), 1),
+                "price_level": rng.randint(1, 4),
+                "types": [str(keyword), "point_of_interest"],
+                "vicinity": f"{i} Example Street",
+                "opening_hours": {"open_now": True},
+                "place_id": f"{keyword}-{lat:.3f}-{lng:.3f}-{i}",
+                "geometry": {"location": {"lat": lat + rng.uniform(-0.01, 0.01), "lng": lng + rng.uniform(-0.01, 0.01)}},
+            })
+        return {"results": results}
+
+
+class FakeHttpClient:
+    """Stand-in for `requests` as used to download static map images"""
+
+    def __init__(self, latency: float, counter: CallCounter):
+        self.latency = latency
+        self.counter = counter
+
+    def get(self, url, timeout=None):
+        self.counter.hit("maps.static_map")
+        time.sleep(self.latency)
+        return SimpleNamespace(status_code=200, headers={"content-type": "image/png"}, content=b"\x89PNG" + b"\0" * 20000)
+
+
+class FakeRedisClient:
+    """In-process stand-in for the redis-py calls RedisCache makes (GET, SET PX/NX, DEL, EVAL)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}  # key -> (expires_at or None, bytes)
+
+    def _live(self, key):
+        entry = self._data.get(key)
+        if entry and entry[0] is not None and entry[0] <= time.time():
+            del self._data[key]
+            entry = None
+        return entry
+
+    def get(self, name):
+        with self._lock:
+            entry = self._live(name)
+            return entry[1] if entry else None
+
+    def set(self, name, value, px=None, nx=False):
+        if not isinstance(value, (bytes, str, int, float)):
+            raise TypeError(f"Invalid input of type {type(value).__name__}")
+        with self._lock:
+            if nx and self._live(name):
+                return None
+            value = value if isinstance(value, bytes) else str(value).encode()
+            self._data[name] = (time.time() + px / 1000 if px else None, value)
+            return True
+
+    def delete(self, *names):
+        with self._lock:
+            return sum(self._data.pop(name, None) is not None for name in names)
+
+    def eval(self, script, numkeys, *args):
+        """Runs only RedisCache.RELEASE_SCRIPT: delete KEYS[1] if it holds ARGV[1]"""
+        if script != lg.RedisCache.RELEASE_SCRIPT:
+            raise NotImplementedError("FakeRedisClient only evaluates RedisCache.RELEASE_SCRIPT")
+        key, token = args[0], args[1]
+        with self._lock:
+            entry = self._live(key)
+            if entry and entry[1] == token.encode():
+                del self._data[key]
+                return 1
+            return 0
+
+
+def create_cache_backend(url: str) -> lg.CacheBackend:
+    """lg.create_cache_backend, plus fakeredis:// for RedisCache over FakeRedisClient"""
+    if url.startswith("fakeredis://"):
+        return lg.RedisCache(client=FakeRedisClient())
+    return lg.create_cache_backend(url)
+
+
+class FakeCompletions:
+    """Stand-in for openai.chat.completions with latency and simulated prefix caching"""
+
+    def __init__(self, latency: float, counter: CallCounter):
+        self.latency = latency
+        self.counter = counter
+        self._lock = threading.Lock()
+        self._seen_prefixes = set()  # Hashes of every cacheable prefix sent so far
+
+    def create(self, model=None, messages=None, max_tokens=None, temperature=None, response_format=None, **kwargs):
+        self.counter.hit("openai.chat")
+        time.sleep(self.latency)
+
+        # Like the API, only the longest previously seen prefix counts, from 1024 tokens
+        # in 128-token steps (~4 characters per token)
+        prompt = "".join(f"{m['role']}\0{m['content']}\1" for m in messages)
+        prompt_tokens = len(prompt) // 4
+        boundaries = [tokens * 4 for tokens in range(PROMPT_CACHE_MIN_TOKENS, prompt_tokens + 1, PROMPT_CACHE_STEP_TOKENS)]
+        hashes = [hashlib.sha256(prompt[:end].encode()).digest() for end in boundaries]
+        with self._lock:
+            cached_chars = max((end for end, digest in zip(boundaries, hashes) if digest in self._seen_prefixes), default=0)
+            self._seen_prefixes.update(hashes)
+        cached_tokens = cached_chars // 4
+
+        reply = "Here are a few places worth a visit nearby. " * 24  # ~260 tokens, like a 2-3 paragraph answer
+        if response_format:
+            content = json.dumps({
+                "reply": reply,
+                "preference_delta": {
+                    **{field: [] for field in lg.PREFERENCE_LIST_FIELDS},
+                    "food_preferences": ["sushi"] if "sushi" in messages[-1]["content"].lower() else [],
+                    "price_range": "budget" if "budget" in messages[-1]["content"].lower() else "unknown",
+                    "group_size": "unknown",
+                },
+            })
+        else:
+            content = reply
+
+        usage = SimpleNamespace(
+            prompt_tokens=prompt_tokens,
+            completion_tokens=len(content) // 4,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens),
+        )
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+
+class SimulatedSession:
+    """One user session driving main()'s turn helpers against its own state instead of st.session_state"""
+
+    def __init__(self, session_id: str, location: lg.Location, guide: lg.LocalGuide,
+                 store: lg.ConversationStore, ad_manager: lg.AdManager):
+        self.location = location
+        self.guide = guide
+        self.store = store
+        self.ad_manager = ad_manager
+        self.state = SimpleNamespace(session_id=session_id)
+        lg.init_conversation(store, location.label, self.state)
+
+    def rerun(self) -> None:
+        """The work every rerun of main() does before handling input, minus the drawing"""
+        self.guide.prefetcher.invalidate(self.state.session_id, self.location)
+        if len(self.state.messages) > 2:
+            self.ad_manager.sidebar_ad()
+        for message in lg.earlier_messages(self.store, self.state) + self.state.messages:
+            if message.get("attachments"):
+                lg.attachment_map(message["attachments"], self.guide.cache)
+
+    def show_ad(self, ad) -> None:
+        if ad:
+            self.ad_manager.record_impression(ad, "inline")  # What render_ad does besides drawing
+
+    def run_step(self, flow: str, payload) -> None:
+        if flow == "replay":
+            # A "Load earlier messages" click, then the rerun that redraws history
+            if self.state.message_count > len(self.state.messages):
+                self.state.history_pages += 1
+            self.rerun()
+            return
+
+        self.rerun()
+        if flow in ("suggestion", "location_query", "chat"):
+            _, _, ad = lg.answer_query(self.guide, self.store, self.ad_manager, payload, self.location, self.state)
+        elif flow == "recommendations":
+            _, ad = lg.add_recommendations(self.guide, self.store, self.ad_manager, payload, self.location, self.state)
+        else:
+            _, ad = lg.add_itinerary(self.guide, self.store, self.ad_manager, self.location, self.state)
+        self.show_ad(ad)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if len(sorted_values) == 1:
+        return sorted_values[0]
+    return statistics.quantiles(sorted_values, n=100, method="inclusive")[int(pct) - 1]
+
+
+def merge_cache_stats(caches: List[lg.Cache]) -> Dict[str, Dict]:
+    """Sum per-namespace counters over every worker's Cache"""
+    merged = defaultdict(lambda: defaultdict(int))
+    for cache in caches:
+        for namespace, stats in cache.stats().items():
+            for stat in ("hits", "misses", "waits", "errors"):
+                merged[namespace][stat] += stats[stat]
+    summary = {}
+    for namespace, stats in merged.items():
+        lookups = stats["hits"] + stats["misses"] + stats["waits"]
+        summary[namespace] = {**stats, "hit_rate": (stats["hits"] + stats["waits"]) / lookups if lookups else 0.0}
+    return summary
+
+
+def run_benchmark(args) -> Dict:
+    # The conversation store and ad event log live in a directory removed afterwards
+    with tempfile.TemporaryDirectory(prefix="local-guide-bench-") as tmpdir:
+        return _run_benchmark(args, tmpdir)
+
+
+def _run_benchmark(args, tmpdir: str) -> Dict:
+    counter = CallCounter()
+    maps = FakeMapsClient(args.maps_latency, counter)
+    openai_client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions(args.llm_latency, counter)))
+    usage_stats = lg.PromptCacheStats()
+    prefetcher = lg.PlacesPrefetcher()
+    map_downloader = lg.ThreadPoolExecutor(max_workers=lg.STATIC_MAP_DOWNLOAD_WORKERS, thread_name_prefix="static-map")
+    # One Cache per simulated worker process, all sharing a backend, as with several Streamlit workers
+    backend = create_cache_backend(args.cache)
+    caches = [lg.Cache(backend) for _ in range(args.workers)]
+    http_client = FakeHttpClient(args.maps_latency, counter)
+
+    store = lg.ConversationStore(os.path.join(tmpdir, "conversations.db"))
+    event_log = lg.AdEventLog(os.path.join(tmpdir, "ad_events.jsonl"))
+    catalogue = lg.AdCatalogue.from_file(lg.AD_CATALOGUE_PATH)
+
+    latencies = defaultdict(list)
+    calls_per_flow = defaultdict(int)
+    errors = []
+    lock = threading.Lock()
+    semaphore = threading.Semaphore(args.concurrency)
+    rng = random.Random(args.seed)
+    plans = [(rng.choice(SCRIPTS), rng.choice(LOCATIONS)) for _ in range(args.sessions)]
+
+    def run_session(index: int) -> None:
+        script, location = plans[index]
+        guide = lg.LocalGuide(usage_stats=usage_stats)
+        guide.openai_client = openai_client
+        guide.gmaps_client = maps
+        guide.maps_api_key = "bench"
+        guide.prefetcher = prefetcher
+        guide.map_downloader = map_downloader
+        guide.cache = caches[index % len(caches)]
+        guide.http_client = http_client
+        guide.session_id = f"bench-{index}"
+        ad_manager = lg.AdManager(catalogue, event_log=event_log, session_id=guide.session_id)
+        session = SimulatedSession(guide.session_id, location, guide, store, ad_manager)
+
+        with semaphore:
+            for flow, payload in script:
+                counter.begin_turn()
+                started = time.perf_counter()
+                try:
+                    session.run_step(flow, payload)
+                except Exception as e:
+                    counter.end_turn()
+                    with lock:
+                        errors.append(f"{flow}: {e!r}")
+                    continue
+                elapsed = time.perf_counter() - started
+                turn_calls = counter.end_turn()
+                with lock:
+                    latencies[flow].append(elapsed)
+                    calls_per_flow[flow] += turn_calls
+                if args.think_time:
+                    time.sleep(args.think_time)
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    threads = [threading.Thread(target=run_session, args=(i,)) for i in range(args.sessions)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.perf_counter() - started
+    map_downloader.shutdown(wait=True)
+    # Closing drains both writers, so their stats include every write
+    store.close()
+    event_log.close()
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    turns = sum(len(values) for values in latencies.values())
+    flows = {}
+    for flow, values in sorted(latencies.items()):
+        values.sort()
+        flows[flow] = {
+            "count": len(values),
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "external_calls_per_turn": calls_per_flow[flow] / len(values),
+        }
+
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "label": args.label,
+        "config": {
+            "sessions": args.sessions,
+            "concurrency": args.concurrency,
+            "maps_latency": args.maps_latency,
+            "llm_latency": args.llm_latency,
+            "think_time": args.think_time,
+            "seed": args.seed,
+            "cache": args.cache,
+            "workers": args.workers,
+        },
+        "wall_time_s": wall_time,
+        "turns": turns,
+        "throughput_turns_per_s": turns / wall_time if wall_time else 0.0,
+        "external_calls": dict(counter.counts),
+        "external_calls_per_turn": counter.total() / turns if turns else 0.0,
+        "background_calls": counter.background,
+        # ru_maxrss is in KB on Linux
+        "peak_rss_growth_kb_per_session": (rss_after - rss_before) / args.sessions,
+        "flows": flows,
+        "prefetch": prefetcher.stats(),
+        "cache": merge_cache_stats(caches),
+        "prompt_cache": usage_stats.summary(),
+        "store": store.stats(),
+        "ad_events": event_log.stats(),
+        "errors": errors[:20],
+    }
+
+
+def print_report(result: Dict, baseline: Dict = None) -> None:
+    print(f"{result['turns']} turns in {result['wall_time_s']:.2f}s "
+          f"({result['throughput_turns_per_s']:.1f} turns/s), "
+          f"{result['external_calls_per_turn']:.2f} external calls/turn "
+          f"({result['background_calls']} in background), "
+          f"{result['peak_rss_growth_kb_per_session']:.1f} KB RSS growth/session")
+    print(f"{'flow':<16}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'calls/turn':>12}")
+    for flow, stats in result["flows"].items():
+        line = (f"{flow:<16}{stats['count']:>7}{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}"
+                f"{stats['p99_ms']:>10.1f}{stats['external_calls_per_turn']:>12.2f}")
+        base = (baseline or {}).get("flows", {}).get(flow)
+        if base:
+            line += f"   p95 {stats['p95_ms'] - base['p95_ms']:+.1f} ms vs baseline"
+        print(line)
+    print(f"prefetch: {result['prefetch']}")
+    print(f"cache: {result['cache']}")
+    if result["errors"]:
+        print(f"errors ({len(result['errors'])}): {result['errors'][:3]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=50, help="simulated sessions")
+    parser.add_argument("--concurrency", type=int, default=50, help="sessions running at once")
+    parser.add_argument("--maps-latency", type=float, default=0.08, help="seconds per Maps call")
+    parser.add_argument("--llm-latency", type=float, default=0.6, help="seconds per OpenAI call")
+    parser.add_argument("--think-time", type=float, default=0.0, help="idle seconds between turns")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--cache", default="memory://",
+                        help="cache URL: memory://, sqlite:///path, redis://... or fakeredis:// (in-process stand-in)")
+    parser.add_argument("--workers", type=int, default=1, help="simulated worker processes sharing the cache backend")
+    parser.add_argument("--label", default="local", help="name stored with the results")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    args = parser.parse_args()
+
+    result = run_benchmark(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_report(result, baseline)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{args.label}-{datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"results saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
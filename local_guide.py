@@ -1,13 +1,30 @@
 import streamlit as st
+import streamlit.components.v1 as components
+import numpy as np
 import openai
 import googlemaps
 import requests
 from datetime import datetime
+import atexit
+import contextvars
+import hashlib
 import json
 import os
+import pickle
+import queue
 import random
-from typing import List, Dict, Optional
+import re
+import secrets
+import sqlite3
+import threading
+import time
+import uuid
+from types import MappingProxyType
+from typing import List, Dict, Optional, Tuple, Union
 import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 
 # Page configuration
 st.set_page_config(
@@ -17,10 +34,862 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
-class LocalGuide:
+# Static prompt prefixes. They take no interpolation so every request starts with
+# an identical, cacheable prefix; location and per-turn data are appended after.
+LOCAL_GUIDE_PROMPT = """You are a helpful LOCAL GUIDE. You ONLY help with travel, tourism, and location-based questions.
+
+STRICT GUIDELINES:
+- ONLY answer questions about: restaurants, attractions, transportation, accommodations, local events, directions, weather, cultural sites, shopping, nightlife, and travel tips
+- REFUSE to answer questions about: politics, personal advice, technical support, medical advice, financial advice, or anything unrelated to being a local guide
+- DO NOT provide sensitive information like personal data, addresses of private individuals, or confidential information
+- BE RESPECTFUL and inclusive - never make discriminatory comments about any group of people
+- If asked non-travel questions, politely redirect: "I'm a local guide focused on helping you explore this area. Ask me about places to visit, eat, or things to do!"
+
+Respond as a friendly local guide who:
+- Gives enthusiastic, practical recommendations
+- Includes walking times, price ranges, best times to visit
+- Shares local tips and hidden gems
+- Mentions alternatives and nearby options
+- Refers to listed places by their reference in brackets, e.g. [A]; links are added automatically
+- Keeps responses concise (2-3 paragraphs max)
+- Stays focused ONLY on travel and local guidance
+
+The location you are guiding for and any places found for the current question follow in later messages.
+
+Put your answer in "reply" (markdown). In "preference_delta", list only preferences the user revealed in their latest message (cuisines, price range, activities, atmosphere, dietary needs, time of day, group size, interests); use empty arrays and "unknown" when there are none.
+
+Remember: You are ONLY a local guide. Politely decline any non-travel related questions."""
+
+RECOMMENDATION_PROMPT = """You are a local guide creating PERSONALIZED recommendations.
+The location, focus, detected preferences, available places and recent conversation follow in the next message.
+
+Create 5-8 personalized recommendations that:
+1. Match the user's demonstrated preferences from our conversation
+2. Include a mix of categories (food, activities, experiences)
+3. Reference specific places from the available options when relevant, by their reference in brackets, e.g. [A]
+4. Explain WHY each recommendation fits their preferences
+5. Include practical details (timing, price range, tips)
+6. Suggest a logical order or grouping for visiting
+
+Format as a friendly, personalized guide response that feels like it's based on getting to know them through our conversation, focused on the requested recommendation type."""
+
+ITINERARY_PROMPT = """Create an itinerary based on this user's preferences.
+The location, time period, preferences and available places follow in the next message.
+
+Create a logical, time-based itinerary that:
+1. Groups nearby locations efficiently
+2. Considers meal times and opening hours
+3. Balances different types of activities
+4. Includes travel time estimates
+5. Provides specific timing suggestions
+6. Matches their demonstrated preferences
+7. Refers to listed places by their reference in brackets, e.g. [A]
+
+Format: 
+**Morning (9:00 AM - 12:00 PM)**
+- Activity with specific time and reasoning
+
+**Afternoon (12:00 PM - 5:00 PM)** 
+- etc."""
+
+# Preference fields the chat completion returns alongside every reply
+PREFERENCE_LIST_FIELDS = (
+    "food_preferences", "activity_types", "atmosphere_preferences",
+    "dietary_restrictions", "time_preferences", "interests"
+)
+PREFERENCE_TEXT_FIELDS = ("price_range", "group_size")
+MAX_PREFERENCE_VALUES = 10  # Per list field in the session profile
+
+GUIDE_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "guide_response",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "reply": {"type": "string"},
+                "preference_delta": {
+                    "type": "object",
+                    "properties": {
+                        **{field: {"type": "array", "items": {"type": "string"}} for field in PREFERENCE_LIST_FIELDS},
+                        "price_range": {"type": "string", "enum": ["budget", "mid-range", "upscale", "unknown"]},
+                        "group_size": {"type": "string", "enum": ["solo", "couple", "family", "group", "unknown"]}
+                    },
+                    "required": list(PREFERENCE_LIST_FIELDS + PREFERENCE_TEXT_FIELDS),
+                    "additionalProperties": False
+                }
+            },
+            "required": ["reply", "preference_delta"],
+            "additionalProperties": False
+        }
+    }
+}
+
+
+# Chat history is trimmed in whole blocks rather than slid every turn, so consecutive
+# turns share the static prompt, location and older history as a cacheable prefix
+CHAT_HISTORY_MIN_MESSAGES = 6  # Most recent messages always included
+CHAT_HISTORY_BLOCK = 8  # The window's start moves forward this many messages at a time
+
+
+def stable_history_window(history: List[Dict]) -> List[Dict]:
+    """Recent history whose first message only changes every CHAT_HISTORY_BLOCK messages"""
+    if len(history) <= CHAT_HISTORY_MIN_MESSAGES:
+        return history
+    # Align on each message's position in the whole conversation, since the hot window itself slides
+    if all("index" in message for message in history):
+        positions = [message["index"] for message in history]
+    else:
+        positions = list(range(len(history)))
+    start = (positions[-1] + 1 - CHAT_HISTORY_MIN_MESSAGES) // CHAT_HISTORY_BLOCK * CHAT_HISTORY_BLOCK
+    return [message for message, position in zip(history, positions) if position >= start]
+
+
+def merge_preferences(profile: Dict, delta: Dict) -> Dict:
+    """Merge a preference delta into a session profile, keeping the newest values"""
+    merged = dict(profile)
+    for field in PREFERENCE_LIST_FIELDS:
+        values = list(merged.get(field, []))
+        for value in delta.get(field) or []:
+            value = value.strip().lower()
+            if value and value not in values:
+                values.append(value)
+        if values:
+            merged[field] = values[-MAX_PREFERENCE_VALUES:]
+    for field in PREFERENCE_TEXT_FIELDS:
+        value = delta.get(field)
+        if value and value != "unknown":
+            merged[field] = value
+    return merged
+
+
+# gpt-4o-mini input pricing, used to estimate prompt caching savings
+INPUT_TOKEN_PRICE = 0.15 / 1_000_000
+CACHED_INPUT_DISCOUNT = 0.5
+
+
+class PromptCacheStats:
+    """Process-wide token usage, cached-token and latency counters per prompt"""
+    
     def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+    
+    def record(self, prompt_name: str, usage, latency: float) -> None:
+        prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached_tokens = getattr(details, "cached_tokens", 0) or 0
+        
+        with self._lock:
+            stats = self._stats.setdefault(prompt_name, {
+                "calls": 0, "cache_hits": 0, "prompt_tokens": 0, "cached_tokens": 0,
+                "completion_tokens": 0, "hit_latency": 0.0, "miss_latency": 0.0
+            })
+            stats["calls"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["cached_tokens"] += cached_tokens
+            stats["completion_tokens"] += getattr(usage, "completion_tokens", 0) or 0
+            if cached_tokens:
+                stats["cache_hits"] += 1
+                stats["hit_latency"] += latency
+            else:
+                stats["miss_latency"] += latency
+    
+    def summary(self) -> Dict[str, Dict]:
+        """Hit rate, cached token share, mean latency with/without hits and estimated savings"""
+        with self._lock:
+            summary = {}
+            for name, s in self._stats.items():
+                misses = s["calls"] - s["cache_hits"]
+                summary[name] = {
+                    "calls": s["calls"],
+                    "hit_rate": s["cache_hits"] / s["calls"] if s["calls"] else 0.0,
+                    "cached_token_share": s["cached_tokens"] / s["prompt_tokens"] if s["prompt_tokens"] else 0.0,
+                    "avg_hit_latency": s["hit_latency"] / s["cache_hits"] if s["cache_hits"] else None,
+                    "avg_miss_latency": s["miss_latency"] / misses if misses else None,
+                    "estimated_savings_usd": s["cached_tokens"] * INPUT_TOKEN_PRICE * CACHED_INPUT_DISCOUNT,
+                }
+            return summary
+
+
+@st.cache_resource
+def get_prompt_cache_stats() -> PromptCacheStats:
+    """One usage tracker per process"""
+    return PromptCacheStats()
+
+
+# Shared cache configuration: memory://, sqlite:///path/to/cache.db or redis://host:port/db
+CACHE_URL = os.environ.get("LOCAL_GUIDE_CACHE_URL", "memory://")
+CACHE_TTLS = {
+    "geocode": 30 * 86400,
+    "reverse_geocode": 30 * 86400,
+    "places": 600,  # Searches use open_now, so keep them short-lived
+    "static_map": 7 * 86400,
+}
+MEMORY_CACHE_MAX_ENTRIES = 10000
+MEMORY_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Map images are ~50 KB each, so entries alone do not bound memory
+SINGLE_FLIGHT_TIMEOUT = 10  # Max seconds to wait for another worker computing the same key
+SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+
+
+class CacheBackend:
+    """Byte store with per-key TTL and a lock that is visible to every worker using it"""
+    
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+    
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        raise NotImplementedError
+    
+    def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        """Take the lock for `key`; returns an ownership token, or None if another holder has it"""
+        raise NotImplementedError
+    
+    def release_lock(self, key: str, token: str) -> None:
+        """Release the lock only if `token` still owns it (it may have expired and been retaken)"""
+        raise NotImplementedError
+
+
+class MemoryCache(CacheBackend):
+    """In-process LRU bounded by entry count and total value size; locks are only visible within this process"""
+    
+    def __init__(self, max_entries: int = MEMORY_CACHE_MAX_ENTRIES, max_bytes: int = MEMORY_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, value)
+        self._bytes = 0
+        self._locks = {}
+    
+    def _discard(self, key: str) -> None:
+        self._bytes -= len(self._entries.pop(key)[1])
+    
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                self._discard(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+    
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+            self._entries[key] = (time.time() + ttl, value)
+            self._bytes += len(value)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+    
+    def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        with self._lock:
+            if self._locks.get(key, (0, None))[0] > time.time():
+                return None
+            token = uuid.uuid4().hex
+            self._locks[key] = (time.time() + ttl, token)
+            return token
+    
+    def release_lock(self, key: str, token: str) -> None:
+        with self._lock:
+            if self._locks.get(key, (0, None))[1] == token:
+                del self._locks[key]
+
+
+class SQLiteCache(CacheBackend):
+    """Cache in a local SQLite file (WAL) shared by every worker on the host"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL);
+            CREATE TABLE IF NOT EXISTS cache_locks (key TEXT PRIMARY KEY, token TEXT NOT NULL, expires REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires);
+        """)
+        conn.commit()
+    
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 connections are per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+    
+    def get(self, key: str) -> Optional[bytes]:
+        row = self._conn().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires >= ?", (key, time.time())
+        ).fetchone()
+        return row[0] if row else None
+    
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        now = time.time()
+        conn = self._conn()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)", (key, value, now + ttl)
+        )
+        # Occasionally sweep expired rows so the file does not grow without bound
+        if random.random() < 0.01:
+            conn.execute("DELETE FROM cache WHERE expires < ?", (now,))
+    
+    def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        now = time.time()
+        token = uuid.uuid4().hex
+        conn = self._conn()
+        conn.execute("DELETE FROM cache_locks WHERE key = ? AND expires < ?", (key, now))
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO cache_locks (key, token, expires) VALUES (?, ?, ?)", (key, token, now + ttl)
+        )
+        return token if cursor.rowcount == 1 else None
+    
+    def release_lock(self, key: str, token: str) -> None:
+        self._conn().execute("DELETE FROM cache_locks WHERE key = ? AND token = ?", (key, token))
+
+
+class RedisCache(CacheBackend):
+    """Cache on any Redis-protocol server; pass `client` to use a local stand-in"""
+    
+    # Compare-and-delete, so a holder whose lock expired cannot release the next holder's
+    RELEASE_SCRIPT = """
+        if redis.call("get", KEYS[1]) == ARGV[1] then
+            return redis.call("del", KEYS[1])
+        end
+        return 0
+    """
+    
+    def __init__(self, url: str = "redis://localhost:6379/0", client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError("The redis package is required for redis:// cache URLs (pip install redis)")
+            client = redis.Redis.from_url(url)
+        self.client = client
+    
+    def get(self, key: str) -> Optional[bytes]:
+        return self.client.get(key)
+    
+    def set(self, key: str, value: bytes, ttl: float) -> None:
+        self.client.set(key, value, px=int(ttl * 1000))
+    
+    def acquire_lock(self, key: str, ttl: float) -> Optional[str]:
+        token = uuid.uuid4().hex
+        return token if self.client.set(f"lock:{key}", token, nx=True, px=int(ttl * 1000)) else None
+    
+    def release_lock(self, key: str, token: str) -> None:
+        self.client.eval(self.RELEASE_SCRIPT, 1, f"lock:{key}", token)
+
+
+def create_cache_backend(url: str) -> CacheBackend:
+    """Build a backend from a memory://, sqlite:///path or redis:// URL"""
+    if url.startswith("memory://"):
+        return MemoryCache()
+    if url.startswith("sqlite:///"):
+        return SQLiteCache(url[len("sqlite:///"):] or "cache.db")
+    if url.startswith("sqlite:"):
+        raise ValueError(f"SQLite cache URLs take three slashes (sqlite:///relative or sqlite:////absolute): {url}")
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisCache(url)
+    raise ValueError(f"Unsupported cache URL: {url}")
+
+
+class Cache:
+    """Namespaced, pickled cache with TTLs, single-flight computation and per-namespace stats"""
+    
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._inflight = {}  # key -> Event set when the local computation finishes
+        self._stats = {}
+    
+    def _count(self, namespace: str, stat: str) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(namespace, {"hits": 0, "misses": 0, "waits": 0, "errors": 0})
+            stats[stat] += 1
+    
+    def _load(self, namespace: str, key: str):
+        try:
+            data = self.backend.get(key)
+        except Exception:
+            self._count(namespace, "errors")
+            return None
+        return pickle.loads(data) if data is not None else None
+    
+    def _store(self, namespace: str, key: str, value, ttl: float) -> None:
+        try:
+            self.backend.set(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), ttl)
+        except Exception:
+            self._count(namespace, "errors")
+    
+    def _key(self, namespace: str, key) -> str:
+        return f"lg:{namespace}:{hashlib.sha1(repr(key).encode()).hexdigest()}"
+    
+    def peek(self, namespace: str, key):
+        """Cached value or None, never computing anything"""
+        value = self._load(namespace, self._key(namespace, key))
+        self._count(namespace, "hits" if value is not None else "misses")
+        return value
+    
+    def get_or_compute(self, namespace: str, key, compute, ttl: Optional[float] = None):
+        """Return the cached value or compute it once across threads and workers; None is never cached"""
+        ttl = ttl or CACHE_TTLS.get(namespace, 600)
+        cache_key = self._key(namespace, key)
+        
+        value = self._load(namespace, cache_key)
+        if value is not None:
+            self._count(namespace, "hits")
+            return value
+        
+        # Single flight within this process
+        with self._lock:
+            event = self._inflight.get(cache_key)
+            leader = event is None
+            if leader:
+                event = self._inflight[cache_key] = threading.Event()
+        
+        if not leader:
+            event.wait(SINGLE_FLIGHT_TIMEOUT)
+            value = self._load(namespace, cache_key)
+            if value is not None:
+                self._count(namespace, "waits")
+                return value
+            self._count(namespace, "misses")
+            return compute()
+        
+        try:
+            return self._compute_across_workers(namespace, cache_key, compute, ttl)
+        finally:
+            with self._lock:
+                del self._inflight[cache_key]
+            event.set()
+    
+    def _try_lock(self, namespace: str, cache_key: str) -> Optional[str]:
+        try:
+            return self.backend.acquire_lock(cache_key, SINGLE_FLIGHT_TIMEOUT)
+        except Exception:
+            self._count(namespace, "errors")
+            return None
+    
+    def _compute_across_workers(self, namespace: str, cache_key: str, compute, ttl: float):
+        token = self._try_lock(namespace, cache_key)
+        
+        if token is None:
+            # Another worker is computing it; wait for its result before doing the work twice.
+            # If it fails or yields None the lock is released without a value, so take over.
+            deadline = time.time() + SINGLE_FLIGHT_TIMEOUT
+            while time.time() < deadline:
+                time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+                value = self._load(namespace, cache_key)
+                if value is not None:
+                    self._count(namespace, "waits")
+                    return value
+                token = self._try_lock(namespace, cache_key)
+                if token is not None:
+                    break
+        
+        self._count(namespace, "misses")
+        try:
+            value = compute()
+            if value is not None:
+                self._store(namespace, cache_key, value, ttl)
+            return value
+        finally:
+            if token is not None:
+                try:
+                    self.backend.release_lock(cache_key, token)
+                except Exception:
+                    self._count(namespace, "errors")
+    
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            summary = {}
+            for namespace, stats in self._stats.items():
+                lookups = stats["hits"] + stats["misses"] + stats["waits"]
+                summary[namespace] = {
+                    **stats,
+                    "hit_rate": (stats["hits"] + stats["waits"]) / lookups if lookups else 0.0
+                }
+            return summary
+
+
+@st.cache_resource
+def get_cache(url: str = CACHE_URL) -> Cache:
+    """One cache client per process; the backend may be shared between processes"""
+    return Cache(create_cache_backend(url))
+
+
+REVERSE_GEOCODE_PRECISION = 4  # Decimal places (~11 m) used as the reverse geocode cache key
+
+
+@dataclass(frozen=True)
+class Location:
+    """Where the guide is answering for; carries coordinates end to end when known"""
+    label: str
+    lat: Optional[float] = None
+    lng: Optional[float] = None
+    
+    def __str__(self) -> str:
+        return self.label
+    
+    @property
+    def has_coordinates(self) -> bool:
+        return self.lat is not None and self.lng is not None
+    
+    @property
+    def coordinates(self) -> Dict:
+        return {'lat': self.lat, 'lng': self.lng}
+    
+    @property
+    def map_center(self) -> str:
+        return f"{self.lat},{self.lng}" if self.has_coordinates else self.label
+
+
+def get_current_location() -> Location:
+    """The session's location, with GPS coordinates while the label still matches them"""
+    label = st.session_state.get('location', 'Current location')
+    gps = st.session_state.get('location_coords')
+    if gps and gps[0] == label:
+        return Location(label, gps[1], gps[2])
+    return Location(label)
+
+
+# Query word -> Places keyword for multi-intent search
+SEARCH_INTENTS = {
+    'breakfast': 'breakfast', 'brunch': 'brunch', 'lunch': 'restaurant', 'dinner': 'restaurant',
+    'restaurant': 'restaurant', 'food': 'restaurant', 'eat': 'restaurant',
+    'coffee shop': 'cafe', 'live music': 'live music', 'hidden gem': 'hidden gem',
+    'coffee': 'cafe', 'cafe': 'cafe', 'bakery': 'bakery', 'pizza': 'pizza', 'burger': 'burger',
+    'sushi': 'sushi', 'ramen': 'ramen', 'thai': 'thai restaurant', 'chinese': 'chinese restaurant',
+    'italian': 'italian restaurant', 'indian': 'indian restaurant', 'vegan': 'vegan restaurant',
+    'drink': 'bar', 'bar': 'bar', 'pub': 'pub', 'beer': 'pub', 'cocktail': 'cocktail bar', 'wine': 'wine bar',
+    'nightlife': 'night club', 'club': 'night club',
+    'shop': 'shopping', 'shopping': 'shopping', 'market': 'market', 'park': 'park', 'museum': 'museum',
+    'gym': 'gym', 'movie': 'movie theater', 'cinema': 'movie theater', 'theater': 'theater', 'theatre': 'theater',
+    'art': 'art gallery', 'gallery': 'art gallery', 'attraction': 'tourist attraction',
+    'bank': 'bank', 'pharmacy': 'pharmacy', 'hospital': 'hospital', 'gas': 'gas station',
+    'hotel': 'hotel', 'accommodation': 'hotel', 'atm': 'atm', 'wifi': 'cafe wifi',
+    'work': 'coworking', 'coworking': 'coworking'
+}
+FOOD_INTENTS = {
+    'breakfast', 'brunch', 'restaurant', 'bakery', 'pizza', 'burger', 'sushi', 'ramen',
+    'thai restaurant', 'chinese restaurant', 'italian restaurant', 'indian restaurant', 'vegan restaurant'
+}
+SEARCH_STOPWORDS = {
+    'a', 'an', 'the', 'and', 'or', 'then', 'any', 'some', 'good', 'best', 'great', 'nice', 'nearby', 'near',
+    'me', 'i', 'we', 'my', 'our', 'to', 'for', 'in', 'on', 'at', 'of', 'with', 'is', 'are', 'where', 'what',
+    'find', 'search', 'recommend', 'place', 'places', 'spot', 'spots', 'around', 'here', 'close', 'can', 'you'
+}
+MAX_SEARCH_INTENTS = 3  # Concurrent Places searches per question
+DEFAULT_SEARCH_INTENT = "tourist attraction"  # For location questions that name nothing specific
+MAX_RANKED_PLACES = 8
+
+# Local ranking: weights over normalized rating, price fit, proximity and intent match
+RANKING_WEIGHTS = {'rating': 0.4, 'price': 0.15, 'distance': 0.25, 'intent': 0.2}
+PRICE_RANGE_LEVELS = {'budget': 1, 'mid-range': 2, 'upscale': 3.5}
+
+
+def rank_places(places: List[Dict], origin: Dict, intents: List[str], radius: int, preferences: Optional[Dict] = None) -> List[Dict]:
+    """Sort places by a vectorized score; each place gets a 'score' and 'distance_m' (None without coordinates)"""
+    if not places:
+        return []
+    
+    def numeric(value, default):
+        return value if isinstance(value, (int, float)) else default
+    
+    rating = np.array([numeric(p.get('rating'), 3.5) for p in places], dtype=float)
+    price = np.array([numeric(p.get('price_level'), 2) for p in places], dtype=float)
+    lat = np.radians([numeric(p.get('geometry', {}).get('location', {}).get('lat'), np.nan) for p in places])
+    lng = np.radians([numeric(p.get('geometry', {}).get('location', {}).get('lng'), np.nan) for p in places])
+    matched = np.array([len(p.get('intents', intents)) for p in places], dtype=float)
+    
+    # Haversine distance from the search origin
+    lat0, lng0 = np.radians(origin['lat']), np.radians(origin['lng'])
+    a = np.sin((lat - lat0) / 2) ** 2 + np.cos(lat0) * np.cos(lat) * np.sin((lng - lng0) / 2) ** 2
+    distance = 2 * 6371000 * np.arcsin(np.sqrt(a))
+    located = ~np.isnan(distance)
+    # Places without coordinates get neutral proximity credit, as if halfway to the radius
+    proximity = np.where(located, 1 - np.clip(np.nan_to_num(distance) / radius, 0, 1), 0.5)
+    
+    target_price = PRICE_RANGE_LEVELS.get((preferences or {}).get('price_range'))
+    price_fit = 1 - np.abs(price - target_price) / 4 if target_price else np.full(len(places), 0.5)
+    
+    score = (
+        RANKING_WEIGHTS['rating'] * rating / 5
+        + RANKING_WEIGHTS['price'] * price_fit
+        + RANKING_WEIGHTS['distance'] * proximity
+        + RANKING_WEIGHTS['intent'] * np.minimum(matched / max(len(intents), 1), 1)
+    )
+    
+    ranked = []
+    for i in np.argsort(-score, kind='stable'):
+        distance_m = int(distance[i]) if located[i] else None
+        ranked.append({**places[i], 'score': round(float(score[i]), 4), 'distance_m': distance_m})
+    return ranked
+
+
+# Compact place context for prompts
+PLACE_CONTEXT_TOKEN_BUDGET = 400  # Approximate tokens for the places table in one prompt
+PLACE_CONTEXT_HEADER = "ref|name|rating|price|dist_m|open|types|area"
+GENERIC_PLACE_TYPES = {'point_of_interest', 'establishment', 'food', 'store'}
+PLACE_REF_PATTERN = re.compile(r"\[([A-Z])\]")
+MARKDOWN_LINK_PATTERN = re.compile(r"\[([^\]]+)\]\(https?://[^)\s]+\)")
+PARTIAL_REPLY_PATTERN = re.compile(r'\s*\{\s*"reply"\s*:\s*"((?:[^"\\]|\\.)*)')  # Leading "reply" string of a guide response
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token) for budgeting"""
+    return len(text) // 4 + 1
+
+
+def dedupe_places(places: List[Dict]) -> List[Dict]:
+    """Drop repeated places (same place_id), keeping the first occurrence"""
+    seen = set()
+    unique = []
+    for place in places:
+        key = place.get('place_id') or place.get('name')
+        if key not in seen:
+            seen.add(key)
+            unique.append(place)
+    return unique
+
+
+def _context_order(places: List[Dict]) -> List[Dict]:
+    """Ranked places keep their order (it matches the map labels); others go by rating"""
+    if all('score' in place for place in places):
+        return list(places)
+    return sorted(places, key=lambda p: p.get('rating') if isinstance(p.get('rating'), (int, float)) else 0, reverse=True)
+
+
+def place_references(places: Optional[List[Dict]]) -> Dict[str, Dict]:
+    """Short reference (A, B, ...) -> place, in the order used by encode_places_context"""
+    return {chr(65 + i): place for i, place in enumerate(_context_order(places or [])[:26])}
+
+
+def encode_places_context(places: List[Dict], token_budget: int = PLACE_CONTEXT_TOKEN_BUDGET) -> Tuple[str, Dict[str, Dict]]:
+    """Encode places as a dense pipe-separated table trimmed to a token budget"""
+    lines = [PLACE_CONTEXT_HEADER]
+    used = estimate_tokens(PLACE_CONTEXT_HEADER)
+    refs = {}
+    
+    for ref, place in place_references(places).items():
+        price = place.get('price_level')
+        types = [t for t in place.get('types', []) if t not in GENERIC_PLACE_TYPES][:2]
+        open_now = place.get('opening_hours')
+        row = "|".join([
+            ref,
+            place.get('name', '').replace("|", "/"),
+            str(place.get('rating', '')) if place.get('rating') != 'N/A' else "",
+            "$" * price if isinstance(price, int) else "",
+            str(place['distance_m']) if place.get('distance_m') is not None else "",
+            "y" if open_now is True else "",
+            ",".join(types),
+            place.get('vicinity', '').replace("|", "/")[:40],
+        ])
+        
+        cost = estimate_tokens(row)
+        if used + cost > token_budget:
+            break
+        lines.append(row)
+        refs[ref] = place
+        used += cost
+    
+    return "\n".join(lines), refs
+
+
+def expand_place_refs(text: str, refs: Dict[str, Dict]) -> str:
+    """Replace [A]-style references in generated text with Maps links"""
+    def expand(match):
+        place = refs.get(match.group(1))
+        if not place:
+            return match.group(0)
+        return f"[{place['name']}]({place['maps_link']})" if place.get('maps_link') else place['name']
+    
+    if not text:
+        return ""
+    return PLACE_REF_PATTERN.sub(expand, text)
+
+
+def partial_reply(content: str) -> Optional[str]:
+    """Recover the reply text from a guide response cut off mid-JSON"""
+    match = PARTIAL_REPLY_PATTERN.match(content)
+    if not match or not match.group(1).strip():
+        return None
+    # The cut may land inside an escape sequence (at most 5 chars of "\uXXXX"); trim until it decodes
+    text = match.group(1)
+    for end in range(len(text), max(len(text) - 6, -1), -1):
+        try:
+            return json.loads(f'"{text[:end]}"') or None
+        except ValueError:
+            continue
+    return None
+
+
+def static_map_key(places: List[Dict], center_location: Union[str, Location]) -> str:
+    """Cache key for a static map: its centre and markers, without the API key"""
+    center = center_location.map_center if isinstance(center_location, Location) else str(center_location)
+    markers = [
+        f"{place['geometry']['location']['lat']:.6f},{place['geometry']['location']['lng']:.6f}"
+        for place in places[:5] if place.get('geometry', {}).get('location')
+    ]
+    return f"{center}|{';'.join(markers)}"
+
+
+# Place searches behind the sidebar recommendation buttons
+RECOMMENDATION_QUERIES = {
+    "general": ["restaurant", "cafe", "attraction", "shopping"],
+    "food": ["restaurant", "cafe", "bakery", "bar"],
+    "activities": ["museum", "park", "entertainment", "shopping"],
+    "nightlife": ["bar", "club", "restaurant", "entertainment"]
+}
+RECOMMENDATION_RADIUS = 2000
+ITINERARY_QUERIES = ["restaurant", "cafe", "attraction", "shopping", "park"]
+ITINERARY_RADIUS = 1500
+
+# Searches warmed in the background for the Food, Activities, Surprise Me and Itinerary buttons
+PREFETCH_JOBS = tuple(dict.fromkeys(
+    [(query, RECOMMENDATION_RADIUS) for rec_type in ("food", "activities", "general") for query in RECOMMENDATION_QUERIES[rec_type]]
+    + [(query, ITINERARY_RADIUS) for query in ITINERARY_QUERIES]
+))
+PREFETCH_WORKERS = 4
+PREFETCH_MAX_SESSIONS = 200  # Oldest sessions' prefetches are dropped beyond this
+PREFETCH_TTL = 600  # Seconds before prefetched results are considered stale
+PREFETCH_WAIT_TIMEOUT = 10  # Max seconds to wait on a prefetch that is already running
+PREFETCH_SESSION_BACKLOG = 8  # Max not-yet-finished prefetches per session; topped up each turn
+PREFETCH_MAX_PENDING = 64  # Max not-yet-finished prefetches across all sessions
+STATIC_MAP_DOWNLOAD_WORKERS = 2  # Map images are cached for replay off the render path
+
+
+class PlacesPrefetcher:
+    """Warms recommendation place searches on a bounded thread pool while users are idle"""
+    
+    def __init__(self, max_workers: int = PREFETCH_WORKERS, max_sessions: int = PREFETCH_MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self.hits = 0
+        self.misses = 0
+        self.cancelled = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="places-prefetch")
+        self._lock = threading.Lock()
+        self._pending = 0  # Submitted and not yet finished or cancelled
+        self._pending_lock = threading.Lock()  # Separate: done callbacks can run under self._lock
+        self._sessions = OrderedDict()  # session_id -> (location, scheduled_at, {(query, radius): Future})
+    
+    def _cancel(self, futures: Dict) -> None:
+        for future in futures.values():
+            if future.cancel():
+                self.cancelled += 1
+    
+    def _finished(self, future) -> None:
+        with self._pending_lock:
+            self._pending -= 1
+    
+    def invalidate(self, session_id: str, location: "Location") -> None:
+        """Cancel a session's prefetches if they were made for another location"""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry and entry[0] != location:
+                self._cancel(self._sessions.pop(session_id)[2])
+    
+    def schedule(self, session_id: str, guide: "LocalGuide", location: "Location", jobs=PREFETCH_JOBS) -> None:
+        """Queue searches for a session's location, reusing ones already in flight"""
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry and (entry[0] != location or time.time() - entry[1] > PREFETCH_TTL):
+                self._cancel(entry[2])
+                entry = None
+            
+            scheduled_at, futures = (entry[1], entry[2]) if entry else (time.time(), {})
+            # Keep the queue short so it drains quickly and little paid work is wasted
+            backlog = sum(not future.done() for future in futures.values())
+            for query, radius in jobs:
+                if backlog >= PREFETCH_SESSION_BACKLOG or self._pending >= PREFETCH_MAX_PENDING:
+                    break
+                future = futures.get((query, radius))
+                if future is None or future.cancelled():
+                    future = self._executor.submit(
+                        guide.get_nearby_places, location, query, radius, report_errors=False
+                    )
+                    with self._pending_lock:
+                        self._pending += 1
+                    future.add_done_callback(self._finished)
+                    futures[(query, radius)] = future
+                    backlog += 1
+            self._sessions[session_id] = (location, scheduled_at, futures)
+            
+            while len(self._sessions) > self.max_sessions:
+                self._cancel(self._sessions.popitem(last=False)[1][2])
+    
+    def get(self, session_id: str, location: "Location", query: str, radius: int) -> Optional[List[Dict]]:
+        """Return prefetched places, waiting only on a search that has started; None on a miss"""
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            future = None
+            if entry and entry[0] == location and time.time() - entry[1] <= PREFETCH_TTL:
+                future = entry[2].get((query, radius))
+            # A search still queued behind other sessions' work would be slower than
+            # a live one, so drop it and let the caller search now
+            if future is not None and not future.done() and not future.running() and future.cancel():
+                self.cancelled += 1
+            if future is None or future.cancelled():
+                self.misses += 1
+                return None
+        
+        try:
+            places = future.result(timeout=PREFETCH_WAIT_TIMEOUT)
+        except Exception:
+            places = None
+        
+        with self._lock:
+            if places is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return places
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "cancelled": self.cancelled,
+                "pending": self._pending,
+                "sessions": len(self._sessions),
+            }
+
+
+@st.cache_resource
+def get_places_prefetcher() -> PlacesPrefetcher:
+    """One prefetch pool per process"""
+    return PlacesPrefetcher()
+
+
+@st.cache_resource
+def get_map_downloader() -> ThreadPoolExecutor:
+    """One static map download pool per process"""
+    return ThreadPoolExecutor(max_workers=STATIC_MAP_DOWNLOAD_WORKERS, thread_name_prefix="static-map")
+
+
+class LocalGuide:
+    def __init__(self, usage_stats: Optional[PromptCacheStats] = None):
         self.openai_client = None
         self.gmaps_client = None
+        self.usage_stats = usage_stats
+        self.prefetcher = None
+        self.session_id = None
+        self.place_context_budget = PLACE_CONTEXT_TOKEN_BUDGET
+        self.cache = None
+        self.http_client = requests
+        self.map_downloader = None
     
     def setup_apis(self, openai_key=None, gmaps_key=None):
         """Initialize API clients"""
@@ -96,65 +965,144 @@ class LocalGuide:
         """
     
     def reverse_geocode(self, lat: float, lng: float) -> str:
-        """Convert coordinates to address"""
+        """Convert coordinates to a display address, memoized on a quantized coordinate"""
         if not self.gmaps_client:
             return f"{lat}, {lng}"
         
+        lat_q, lng_q = round(lat, REVERSE_GEOCODE_PRECISION), round(lng, REVERSE_GEOCODE_PRECISION)
+        
+        def lookup():
+            result = self.gmaps_client.reverse_geocode((lat_q, lng_q))
+            return result[0]['formatted_address'] if result else None
+        
         try:
-            result = self.gmaps_client.reverse_geocode((lat, lng))
-            if result:
-                return result[0]['formatted_address']
-            return f"{lat}, {lng}"
+            return self._cached("reverse_geocode", (lat_q, lng_q), lookup) or f"{lat}, {lng}"
         except:
             return f"{lat}, {lng}"
     
-    def get_nearby_places(self, location: str, query: str, radius: int = 1000) -> List[Dict]:
+    def _cached(self, namespace: str, key, compute):
+        """Read through the shared cache when one is configured"""
+        if self.cache is None:
+            return compute()
+        return self.cache.get_or_compute(namespace, key, compute)
+    
+    def resolve_coordinates(self, location: Union[str, Location]) -> Optional[Dict]:
+        """Coordinates for a location, geocoding only when it has none"""
+        if isinstance(location, Location) and location.has_coordinates:
+            return location.coordinates
+        
+        def lookup():
+            geocode_result = self.gmaps_client.geocode(str(location))
+            return geocode_result[0]['geometry']['location'] if geocode_result else None
+        
+        return self._cached("geocode", str(location).strip().lower(), lookup)
+    
+    def get_places(self, location: Union[str, Location], query: str, radius: int) -> List[Dict]:
+        """Places search that uses prefetched results when they are available"""
+        if self.prefetcher:
+            places = self.prefetcher.get(self.session_id, location, query, radius)
+            if places is not None:
+                return places
+        return self.get_nearby_places(location, query, radius)
+    
+    def get_nearby_places(self, location: Union[str, Location], query: str, radius: int = 1000, report_errors: bool = True) -> List[Dict]:
         """Search for nearby places using Google Places API"""
         if not self.gmaps_client:
             return []
         
         try:
-            # First, geocode the location
-            geocode_result = self.gmaps_client.geocode(location)
-            if not geocode_result:
+            # Coordinate-native locations skip the geocode round trip
+            lat_lng = self.resolve_coordinates(location)
+            if not lat_lng:
                 return []
             
-            lat_lng = geocode_result[0]['geometry']['location']
-            
-            # Search for nearby places
-            places_result = self.gmaps_client.places_nearby(
-                location=lat_lng,
-                radius=radius,
-                keyword=query,
-                open_now=True
-            )
+            return self._search_nearby(lat_lng, query, radius)[:8]  # Limit to 8 results for better display
             
-            # Format results
-            places = []
-            for place in places_result.get('results', [])[:8]:  # Limit to 8 results for better display
-                place_details = {
-                    'name': place.get('name', ''),
-                    'rating': place.get('rating', 'N/A'),
-                    'price_level': place.get('price_level', 'N/A'),
-                    'types': place.get('types', []),
-                    'vicinity': place.get('vicinity', ''),
-                    'opening_hours': place.get('opening_hours', {}).get('open_now', 'Unknown'),
-                    'place_id': place.get('place_id', ''),
-                    'geometry': place.get('geometry', {}),
-                    'photos': place.get('photos', [])
-                }
-                
-                # Generate Google Maps links
-                place_details['maps_link'] = self.generate_maps_link(place_details)
-                place_details['directions_link'] = self.generate_directions_link(place_details, lat_lng)
-                
-                places.append(place_details)
+        except Exception as e:
+            if report_errors:
+                st.error(f"Places search error: {str(e)}")
+            return []
+    
+    def _search_nearby(self, lat_lng: Dict, query: str, radius: int) -> List[Dict]:
+        """One Places nearby search around known coordinates, formatted with links"""
+        key = (round(lat_lng['lat'], 5), round(lat_lng['lng'], 5), query, radius)
+        return self._cached("places", key, lambda: self._fetch_nearby(lat_lng, query, radius))
+    
+    def _fetch_nearby(self, lat_lng: Dict, query: str, radius: int) -> List[Dict]:
+        places_result = self.gmaps_client.places_nearby(
+            location=lat_lng,
+            radius=radius,
+            keyword=query,
+            open_now=True
+        )
+        
+        # Format results
+        places = []
+        for place in places_result.get('results', []):
+            place_details = {
+                'name': place.get('name', ''),
+                'rating': place.get('rating', 'N/A'),
+                'price_level': place.get('price_level', 'N/A'),
+                'types': place.get('types', []),
+                'vicinity': place.get('vicinity', ''),
+                'opening_hours': place.get('opening_hours', {}).get('open_now', 'Unknown'),
+                'place_id': place.get('place_id', ''),
+                'geometry': place.get('geometry', {}),
+                'photos': place.get('photos', [])
+            }
             
-            return places
+            # Generate Google Maps links
+            place_details['maps_link'] = self.generate_maps_link(place_details)
+            place_details['directions_link'] = self.generate_directions_link(place_details, lat_lng)
             
+            places.append(place_details)
+        
+        return places
+    
+    def find_places(self, location: Union[str, Location], intents: List[str], radius: int = 1000, preferences: Optional[Dict] = None) -> List[Dict]:
+        """Search every intent concurrently, merge by place_id and rank locally"""
+        if not self.gmaps_client or not intents:
+            return []
+        
+        try:
+            lat_lng = self.resolve_coordinates(location)
         except Exception as e:
             st.error(f"Places search error: {str(e)}")
             return []
+        if not lat_lng:
+            return []
+        
+        # Each search runs in a copy of the caller's context so context-local state follows it
+        with ThreadPoolExecutor(max_workers=len(intents), thread_name_prefix="places-search") as executor:
+            futures = [
+                executor.submit(contextvars.copy_context().run, self._search_nearby, lat_lng, intent, radius)
+                for intent in intents
+            ]
+        
+        merged = {}
+        errors = []
+        for intent, future in zip(intents, futures):
+            try:
+                results = future.result()
+            except Exception as e:
+                errors.append(str(e))
+                continue
+            for place in results:
+                key = place['place_id'] or f"{place['name']}|{place['vicinity']}"
+                if key not in merged:
+                    merged[key] = {**place, 'intents': []}
+                merged[key]['intents'].append(intent)
+        
+        if errors and not merged:
+            st.error(f"Places search error: {errors[0]}")
+        
+        return rank_places(list(merged.values()), lat_lng, intents, radius, preferences)[:MAX_RANKED_PLACES]
+    
+    def search_places_for_query(self, user_query: str, location: Union[str, Location], preferences: Optional[Dict] = None) -> List[Dict]:
+        """Places for a chat question, or [] when it is not location-based"""
+        if not self.is_location_query(user_query):
+            return []
+        return self.find_places(location, self.extract_search_intents(user_query), preferences=preferences)
     
     def generate_maps_link(self, place: Dict) -> str:
         """Generate Google Maps link for a place"""
@@ -177,11 +1125,14 @@ class LocalGuide:
             dest_name = urllib.parse.quote(f"{place.get('name', '')} {place.get('vicinity', '')}")
             return f"https://www.google.com/maps/dir/{origin['lat']},{origin['lng']}/{dest_name}"
     
-    def generate_static_map(self, places: List[Dict], center_location: str) -> str:
+    def generate_static_map(self, places: List[Dict], center_location: Union[str, Location]) -> str:
         """Generate static map URL with markers"""
         if not hasattr(self, 'maps_api_key') or not places:
             return None
         
+        if isinstance(center_location, Location):
+            center_location = center_location.map_center
+        
         base_url = "https://maps.googleapis.com/maps/api/staticmap"
         
         # Map parameters
@@ -213,81 +1164,78 @@ class LocalGuide:
         
         return f"{base_url}?{param_string}"
     
-    def analyze_user_preferences(self, conversation_history: List[Dict]) -> Dict:
-        """Analyze chat history to extract user preferences"""
-        if not self.openai_client or len(conversation_history) < 3:
-            return {}
-        
-        # Extract user messages only
-        user_messages = [msg['content'] for msg in conversation_history if msg['role'] == 'user']
-        chat_context = " | ".join(user_messages[-10:])  # Last 10 user messages
-        
-        analysis_prompt = f"""
-        Analyze these user messages from a local guide conversation and extract preferences:
-        
-        Messages: {chat_context}
-        
-        Extract and return ONLY a JSON object with these keys:
-        {{
-            "food_preferences": ["cuisine1", "cuisine2"],
-            "price_range": "budget/mid-range/upscale",
-            "activity_types": ["activity1", "activity2"],
-            "atmosphere_preferences": ["casual", "romantic", "family-friendly"],
-            "dietary_restrictions": ["vegetarian", "vegan", "gluten-free"],
-            "time_preferences": ["morning", "afternoon", "evening"],
-            "group_size": "solo/couple/family/group",
-            "interests": ["interest1", "interest2"]
-        }}
-        
-        If no clear preferences, use empty arrays or "unknown" for strings.
-        """
+    def fetch_static_map(self, places: List[Dict], center_location: Union[str, Location]) -> Optional[bytes]:
+        """Static map image bytes, kept in the cache so past results re-render without a request"""
+        map_url = self.generate_static_map(places, center_location)
+        if not map_url:
+            return None
+        
+        def download():
+            response = self.http_client.get(map_url, timeout=10)
+            if response.status_code == 200 and response.headers.get('content-type', '').startswith('image/'):
+                return response.content
+            return None
         
         try:
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": analysis_prompt}],
-                max_tokens=300,
-                temperature=0.3
-            )
-            
-            # Parse JSON response
-            preferences = json.loads(response.choices[0].message.content.strip())
-            return preferences
-        except Exception as e:
-            st.error(f"Preference analysis error: {str(e)}")
-            return {}
-
-    def generate_personalized_recommendations(self, location: str, conversation_history: List[Dict], recommendation_type: str = "general") -> str:
+            return self._cached("static_map", static_map_key(places, center_location), download)
+        except requests.RequestException:
+            return None
+    
+    def schedule_static_map(self, places: List[Dict], center_location: Union[str, Location]) -> None:
+        """Fetch the static map on the download pool so later reruns can show it from the cache"""
+        if self.map_downloader is not None and places:
+            self.map_downloader.submit(self.fetch_static_map, places, center_location)
+    
+    def build_place_attachments(self, places: List[Dict], center_location: Union[str, Location]) -> Dict:
+        """Structured map and link data stored with a message for cheap replay"""
+        return {
+            "map_key": static_map_key(places, center_location),
+            "places": [
+                {
+                    "place_id": place.get('place_id', ''),
+                    "name": place['name'],
+                    "rating": place.get('rating', 'N/A'),
+                    "price_level": place.get('price_level', 'N/A'),
+                    "lat": place.get('geometry', {}).get('location', {}).get('lat'),
+                    "lng": place.get('geometry', {}).get('location', {}).get('lng'),
+                    "maps_link": place.get('maps_link', ''),
+                    "directions_link": place.get('directions_link', '')
+                }
+                for place in places
+            ]
+        }
+    
+    def _complete(self, prompt_name: str, messages: List[Dict], **kwargs):
+        """Run a chat completion and record token usage and latency"""
+        started = time.perf_counter()
+        response = self.openai_client.chat.completions.create(
+            model="gpt-4o-mini",
+            messages=messages,
+            **kwargs
+        )
+        if self.usage_stats:
+            self.usage_stats.record(prompt_name, getattr(response, "usage", None), time.perf_counter() - started)
+        return response
+    
+    def generate_personalized_recommendations(self, location: Union[str, Location], conversation_history: List[Dict], recommendation_type: str = "general", preferences: Optional[Dict] = None) -> str:
         """Generate AI-powered personalized recommendations based on chat history"""
         if not self.openai_client:
             return "Sorry, I need an OpenAI API key to generate personalized recommendations."
         
-        # Analyze user preferences
-        preferences = self.analyze_user_preferences(conversation_history)
-        
         # Get diverse places data for recommendations
-        recommendation_queries = {
-            "general": ["restaurant", "cafe", "attraction", "shopping"],
-            "food": ["restaurant", "cafe", "bakery", "bar"],
-            "activities": ["museum", "park", "entertainment", "shopping"],
-            "nightlife": ["bar", "club", "restaurant", "entertainment"]
-        }
-        
-        queries = recommendation_queries.get(recommendation_type, recommendation_queries["general"])
+        queries = RECOMMENDATION_QUERIES.get(recommendation_type, RECOMMENDATION_QUERIES["general"])
         all_places = []
         
         for query in queries:
-            places = self.get_nearby_places(location, query, radius=2000)
+            places = self.get_places(location, query, RECOMMENDATION_RADIUS)
             all_places.extend(places[:3])  # Top 3 from each category
+        all_places = dedupe_places(all_places)
         
         # Create personalized recommendation prompt
         places_context = ""
         if all_places:
-            places_context = "\n\nAvailable places to recommend from:\n"
-            for i, place in enumerate(all_places, 1):
-                places_context += f"{i}. {place['name']} - {place.get('vicinity', '')}\n"
-                places_context += f"   Rating: {place.get('rating', 'N/A')}, Price: {'💰' * (place.get('price_level', 1) if place.get('price_level', 1) != 'N/A' else 1)}\n"
-                places_context += f"   Types: {', '.join(place.get('types', [])[:3])}\n"
+            places_table, _ = encode_places_context(all_places, self.place_context_budget)
+            places_context = f"\nAvailable places to recommend from:\n{places_table}\n"
         
         # Extract recent conversation context
         recent_messages = conversation_history[-8:] if len(conversation_history) > 8 else conversation_history
@@ -296,166 +1244,141 @@ class LocalGuide:
             role = "User" if msg['role'] == 'user' else "Guide"
             conversation_context += f"{role}: {msg['content'][:100]}...\n"
         
-        recommendation_prompt = f"""
-        You are a local guide creating PERSONALIZED recommendations for {location}.
-        
-        RECENT CONVERSATION CONTEXT:
-        {conversation_context}
-        
-        USER PREFERENCES DETECTED:
-        {json.dumps(preferences, indent=2) if preferences else "No specific preferences detected yet"}
-        
-        {places_context}
-        
-        Create 5-8 personalized recommendations that:
-        1. Match the user's demonstrated preferences from our conversation
-        2. Include a mix of categories (food, activities, experiences)
-        3. Reference specific places from the available options when relevant
-        4. Explain WHY each recommendation fits their preferences
-        5. Include practical details (timing, price range, tips)
-        6. Suggest a logical order or grouping for visiting
-        
-        Format as a friendly, personalized guide response that feels like it's based on getting to know them through our conversation.
-        
-        Focus on recommendations for: {recommendation_type}
-        """
+        # Static instructions first, then location, then per-request data
+        request_prompt = f"""LOCATION: {location}
+
+FOCUS: {recommendation_type}
+
+USER PREFERENCES DETECTED:
+{json.dumps(preferences, indent=2) if preferences else "No specific preferences detected yet"}
+{places_context}
+RECENT CONVERSATION CONTEXT:
+{conversation_context}"""
         
         try:
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": recommendation_prompt}],
+            response = self._complete(
+                "recommendations",
+                [
+                    {"role": "system", "content": RECOMMENDATION_PROMPT},
+                    {"role": "user", "content": request_prompt}
+                ],
                 max_tokens=800,
                 temperature=0.7
             )
-            return response.choices[0].message.content
+            return expand_place_refs(response.choices[0].message.content, place_references(all_places))
         except Exception as e:
             return f"Sorry, I couldn't generate recommendations: {str(e)}"
 
-    def create_recommendation_itinerary(self, location: str, conversation_history: List[Dict], time_period: str = "half_day") -> str:
+    def create_recommendation_itinerary(self, location: Union[str, Location], conversation_history: List[Dict], time_period: str = "half_day", preferences: Optional[Dict] = None) -> str:
         """Generate a time-based itinerary based on user preferences"""
         if not self.openai_client:
             return "API key required for itinerary generation."
         
-        preferences = self.analyze_user_preferences(conversation_history)
-        
         # Get places for itinerary
         all_places = []
-        for query in ["restaurant", "cafe", "attraction", "shopping", "park"]:
-            places = self.get_nearby_places(location, query, radius=1500)
+        for query in ITINERARY_QUERIES:
+            places = self.get_places(location, query, ITINERARY_RADIUS)
             all_places.extend(places[:2])
+        all_places = dedupe_places(all_places)
+        places_table, _ = encode_places_context(all_places, self.place_context_budget)
         
-        itinerary_prompt = f"""
-        Create a {time_period} itinerary for {location} based on this user's preferences:
-        
-        User Preferences: {json.dumps(preferences, indent=2) if preferences else "General preferences"}
-        
-        Available Places:
-        {chr(10).join([f"- {p['name']} ({p.get('vicinity', '')}) - Rating: {p.get('rating', 'N/A')}" for p in all_places[:12]])}
-        
-        Create a logical, time-based itinerary that:
-        1. Groups nearby locations efficiently
-        2. Considers meal times and opening hours
-        3. Balances different types of activities
-        4. Includes travel time estimates
-        5. Provides specific timing suggestions
-        6. Matches their demonstrated preferences
-        
-        Format: 
-        **Morning (9:00 AM - 12:00 PM)**
-        - Activity with specific time and reasoning
-        
-        **Afternoon (12:00 PM - 5:00 PM)** 
-        - etc.
-        """
+        # Static instructions first, then location, then per-request data
+        request_prompt = f"""LOCATION: {location}
+
+TIME PERIOD: {time_period}
+
+User Preferences: {json.dumps(preferences, indent=2) if preferences else "General preferences"}
+
+Available Places:
+{places_table}"""
         
         try:
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": itinerary_prompt}],
+            response = self._complete(
+                "itinerary",
+                [
+                    {"role": "system", "content": ITINERARY_PROMPT},
+                    {"role": "user", "content": request_prompt}
+                ],
                 max_tokens=700,
                 temperature=0.6
             )
-            return response.choices[0].message.content
+            return expand_place_refs(response.choices[0].message.content, place_references(all_places))
         except Exception as e:
             return f"Itinerary generation error: {str(e)}"
     
-    def create_local_guide_prompt(self, user_query: str, location: str, places_data: List[Dict]) -> str:
-        """Create a prompt that makes the AI act like a focused local guide"""
+    def create_local_guide_prompt(self, user_query: str, location: Union[str, Location], places_data: List[Dict], conversation_history: List[Dict]) -> List[Dict]:
+        """Build chat messages ordered static prefix -> location -> history -> per-turn data"""
         
         places_info = ""
         if places_data:
-            places_info = "\n\nHere are some relevant local places I found:\n"
-            for i, place in enumerate(places_data, 1):
-                price_indicator = "💰" * (place.get('price_level', 1) if place.get('price_level', 1) != 'N/A' else 1)
-                places_info += f"{chr(64 + i)}. **{place['name']}** ({place.get('vicinity', 'Unknown location')})\n"
-                places_info += f"   - Rating: {place.get('rating', 'N/A')} ⭐\n"
-                places_info += f"   - Price: {price_indicator}\n"
-                places_info += f"   - Currently open: {'Yes' if place.get('opening_hours') else 'Unknown'}\n"
-                places_info += f"   - Maps: {place.get('maps_link', 'N/A')}\n\n"
+            places_table, _ = encode_places_context(places_data, self.place_context_budget)
+            places_info = f"Here are some relevant local places I found:\n{places_table}"
         
-        prompt = f"""You are a helpful LOCAL GUIDE for {location}. You ONLY help with travel, tourism, and location-based questions.
-
-STRICT GUIDELINES:
-- ONLY answer questions about: restaurants, attractions, transportation, accommodations, local events, directions, weather, cultural sites, shopping, nightlife, and travel tips
-- REFUSE to answer questions about: politics, personal advice, technical support, medical advice, financial advice, or anything unrelated to being a local guide
-- DO NOT provide sensitive information like personal data, addresses of private individuals, or confidential information
-- BE RESPECTFUL and inclusive - never make discriminatory comments about any group of people
-- If asked non-travel questions, politely redirect: "I'm a local guide focused on helping you explore {location}. Ask me about places to visit, eat, or things to do!"
-
-User's question: "{user_query}"
-Location context: {location}
-
-{places_info}
-
-Respond as a friendly local guide who:
-- Gives enthusiastic, practical recommendations
-- Includes walking times, price ranges, best times to visit
-- Shares local tips and hidden gems
-- Mentions alternatives and nearby options
-- Uses Google Maps links when available
-- Keeps responses concise (2-3 paragraphs max)
-- Stays focused ONLY on travel and local guidance
-
-Remember: You are ONLY a local guide. Politely decline any non-travel related questions."""
-
-        return prompt
-    
-    def chat_with_guide(self, user_query: str, location: str, conversation_history: List[Dict]) -> str:
-        """Generate AI response using OpenAI with local context"""
-        if not self.openai_client:
-            return "Sorry, I need an OpenAI API key to help you. Please add it in the sidebar."
-        
-        # Extract keywords for place search
-        search_keywords = self.extract_search_keywords(user_query)
+        messages = [
+            {"role": "system", "content": LOCAL_GUIDE_PROMPT},
+            {"role": "system", "content": f"Location context: {location}"}
+        ]
         
-        # Get nearby places data
-        places_data = []
-        if search_keywords and self.is_location_query(user_query):
-            places_data = self.get_nearby_places(location, search_keywords)
+        # Add recent conversation history, trimmed in blocks so it forms a growing shared
+        # prefix across turns, with expanded place links collapsed back to names to save tokens
+        for msg in stable_history_window(conversation_history):
+            messages.append({"role": msg["role"], "content": MARKDOWN_LINK_PATTERN.sub(r"\1", msg["content"])})
         
-        # Create the prompt
-        system_prompt = self.create_local_guide_prompt(user_query, location, places_data)
+        # Per-turn data goes last so everything before it stays cacheable
+        if places_info:
+            messages.append({"role": "system", "content": places_info})
+        messages.append({"role": "user", "content": user_query})
         
-        # Prepare messages for OpenAI
-        messages = [{"role": "system", "content": system_prompt}]
+        return messages
+    
+    def chat_with_guide(self, user_query: str, location: Union[str, Location], conversation_history: List[Dict], places_data: Optional[List[Dict]] = None) -> Tuple[str, Dict]:
+        """Generate AI response using OpenAI with local context, plus a preference delta"""
+        if not self.openai_client:
+            return "Sorry, I need an OpenAI API key to help you. Please add it in the sidebar.", {}
         
-        # Add conversation history (last 6 messages to keep context manageable)
-        for msg in conversation_history[-6:]:
-            messages.append(msg)
+        # Search only if the caller has not already done so
+        if places_data is None:
+            places_data = self.search_places_for_query(user_query, location)
         
-        messages.append({"role": "user", "content": user_query})
+        messages = self.create_local_guide_prompt(user_query, location, places_data, conversation_history)
         
         try:
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=messages,
-                max_tokens=600,
-                temperature=0.7
+            response = self._complete(
+                "chat",
+                messages,
+                max_tokens=700,
+                temperature=0.7,
+                response_format=GUIDE_RESPONSE_FORMAT
             )
-            return response.choices[0].message.content
-            
+            choice = response.choices[0]
         except Exception as e:
-            return f"Sorry, I encountered an error: {str(e)}"
+            return f"Sorry, I encountered an error: {str(e)}", {}
+        
+        # Structured outputs put refusals in their own field and leave content empty
+        refusal = getattr(choice.message, "refusal", None)
+        if refusal:
+            return refusal, {}
+        content = choice.message.content
+        if not isinstance(content, str) or not content.strip():
+            return "Sorry, I couldn't come up with an answer to that. Could you try rephrasing?", {}
+        
+        # A reply cut off at max_tokens is unterminated JSON; keep what was written
+        if getattr(choice, "finish_reason", None) == "length":
+            reply = partial_reply(content)
+            if reply is None:
+                return "Sorry, my answer ran too long. Could you ask something more specific?", {}
+            return expand_place_refs(reply + " …", place_references(places_data)), {}
+        
+        # The schema is enforced, but never lose the reply if parsing fails
+        try:
+            result = json.loads(content)
+            reply, delta = result["reply"], result.get("preference_delta") or {}
+        except (ValueError, KeyError, TypeError):
+            reply, delta = partial_reply(content) or content, {}
+        if not isinstance(reply, str):
+            reply = content
+        
+        return expand_place_refs(reply, place_references(places_data)), delta
     
     def is_location_query(self, query: str) -> bool:
         """Check if query is asking for location-based recommendations"""
@@ -467,153 +1390,353 @@ Remember: You are ONLY a local guide. Politely decline any non-travel related qu
         query_lower = query.lower()
         return any(indicator in query_lower for indicator in location_indicators)
     
-    def extract_search_keywords(self, query: str) -> str:
-        """Extract relevant keywords for place searching"""
-        food_keywords = ['breakfast', 'lunch', 'dinner', 'coffee', 'restaurant', 'cafe', 'food', 'eat', 'drink', 'pizza', 'burger', 'sushi', 'thai', 'chinese', 'italian']
-        activity_keywords = ['shop', 'shopping', 'park', 'museum', 'gym', 'movie', 'bar', 'nightlife', 'club', 'theater', 'art', 'gallery']
-        service_keywords = ['bank', 'pharmacy', 'hospital', 'gas', 'hotel', 'accommodation', 'atm', 'wifi', 'work', 'coworking']
-        
-        query_lower = query.lower()
+    def extract_search_intents(self, query: str) -> List[str]:
+        """Extract one Places keyword per thing the user is looking for, in query order"""
+        words = re.findall(r"[a-z]+", query.lower())
+        
+        def lookup(term):
+            intent = SEARCH_INTENTS.get(term)
+            if intent is None and term.endswith("s"):
+                intent = SEARCH_INTENTS.get(term[:-1])  # Naive plural fallback
+            return intent
+        
+        intents = []
+        i = 0
+        while i < len(words):
+            # Two-word phrases ("coffee shop") win over their single words
+            intent = lookup(" ".join(words[i:i + 2])) if i + 1 < len(words) else None
+            step = 2 if intent else 1
+            intent = intent or lookup(words[i])
+            if intent and intent not in intents:
+                intents.append(intent)
+            i += step
+        
+        # Generic intents add nothing next to a more specific one ("bar" vs "cocktail bar",
+        # "restaurant" vs "sushi")
+        specific = [intent for intent in intents if intent != "restaurant"]
+        intents = [
+            intent for intent in intents
+            if not any(other != intent and intent in other.split() for other in intents)
+            and not (intent == "restaurant" and any(other in FOOD_INTENTS for other in specific))
+        ]
         
-        # Check for specific food types
-        for keyword in food_keywords:
-            if keyword in query_lower:
-                return keyword if keyword in ['restaurant', 'cafe', 'bar'] else 'restaurant'
+        if not intents:
+            # Fall back to the content words rather than the raw sentence, and to a
+            # generic search when the question is only "best spots nearby?"
+            content_words = [word for word in words if word not in SEARCH_STOPWORDS]
+            return [" ".join(content_words[:3])] if content_words else [DEFAULT_SEARCH_INTENT]
         
-        # Check for activities
-        for keyword in activity_keywords:
-            if keyword in query_lower:
-                return keyword
+        return intents[:MAX_SEARCH_INTENTS]
+
+# Ad catalogue configuration
+AD_CATALOGUE_PATH = os.environ.get(
+    "LOCAL_GUIDE_ADS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "ads.json")
+)
+AD_PACING_INTERVAL = 4  # Show an inline ad every 4th interaction
+AD_FREQUENCY_CAP = 2  # Max impressions of the same ad per session
+AD_PICK_ATTEMPTS = 8  # Random draws from a large pool before giving up on capped ads
+AD_CATEGORIES = ("general", "food", "activities", "accommodation")
+AD_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+class AdCatalogue:
+    """Immutable ad inventory with an inverted keyword index, shared by all sessions"""
+    
+    def __init__(self, ads: List[Dict]):
+        # Freeze every ad so sessions can share the catalogue safely. Keywords are
+        # normalised the way match() tokenises text, so "Wi-Fi" matches "wi-fi" and "wi fi".
+        self.ads = tuple(
+            MappingProxyType({**ad, "keywords": tuple(dict.fromkeys(
+                normalised for normalised in map(normalise_ad_keyword, ad.get("keywords", [])) if normalised
+            ))})
+            for ad in ads
+        )
         
-        # Check for services
-        for keyword in service_keywords:
-            if keyword in query_lower:
-                return keyword
+        by_id = {}
+        keyword_index = {}
+        category_index = {}
+        for ad in self.ads:
+            by_id[ad["id"]] = ad
+            category_index.setdefault(ad.get("category", "general"), []).append(ad)
+            for keyword in ad["keywords"]:
+                keyword_index.setdefault(keyword, []).append(ad)
+        
+        self.by_id = MappingProxyType(by_id)
+        self.keyword_index = MappingProxyType({k: tuple(v) for k, v in keyword_index.items()})
+        self.max_keyword_words = max((len(k.split()) for k in keyword_index), default=1)
+        self.category_index = MappingProxyType({k: tuple(v) for k, v in category_index.items()})
+    
+    @classmethod
+    def from_file(cls, path: str) -> "AdCatalogue":
+        """Load the catalogue from a JSON list or a SQLite database"""
+        if path.endswith((".db", ".sqlite", ".sqlite3")):
+            return cls.from_sqlite(path)
+        with open(path, encoding="utf-8") as f:
+            return cls(json.load(f))
+    
+    @classmethod
+    def from_sqlite(cls, path: str) -> "AdCatalogue":
+        """Load ads from a table `ads(id, category, title, description, url, cta, type, keywords)`"""
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT id, category, title, description, url, cta, type, keywords FROM ads"
+            ).fetchall()
+        finally:
+            conn.close()
+        
+        ads = []
+        for row in rows:
+            ad = dict(row)
+            ad["keywords"] = [k.strip() for k in (ad["keywords"] or "").split(",") if k.strip()]
+            ads.append(ad)
+        return cls(ads)
+    
+    def match(self, text: str) -> Dict[str, int]:
+        """Return ad id -> number of matched keywords for the given text"""
+        words = AD_TOKEN_PATTERN.findall(text.lower())
+        # Every phrase up to the longest keyword, so multi-word keywords can match
+        phrases = {
+            " ".join(words[i:i + n])
+            for n in range(1, self.max_keyword_words + 1)
+            for i in range(len(words) - n + 1)
+        }
         
-        return query  # Return original query if no specific keywords found
+        scores = {}
+        for phrase in phrases:
+            ads = self.keyword_index.get(phrase)
+            if ads is None and phrase.endswith("s"):
+                ads = self.keyword_index.get(phrase[:-1])  # Naive plural fallback
+            for ad in ads or ():
+                scores[ad["id"]] = scores.get(ad["id"], 0) + 1
+        return scores
+    
+    def in_category(self, category: str) -> tuple:
+        """Ads for a category, falling back to general ads"""
+        return self.category_index.get(category) or self.category_index.get("general", ())
+
+
+def normalise_ad_keyword(keyword: str) -> str:
+    """Lowercase a keyword and join its words with single spaces, as match() sees text"""
+    return " ".join(AD_TOKEN_PATTERN.findall(str(keyword).lower()))
+
+
+@st.cache_resource
+def load_ad_catalogue(path: str = AD_CATALOGUE_PATH) -> AdCatalogue:
+    """Load the ad catalogue once per process"""
+    return AdCatalogue.from_file(path)
+
+
+# Ad event pipeline configuration
+AD_EVENT_LOG_PATH = os.environ.get("LOCAL_GUIDE_AD_EVENTS_PATH", "ad_events.jsonl")
+AD_EVENT_BUFFER_SIZE = 10000  # Max events held in memory before dropping
+AD_EVENT_BATCH_SIZE = 500
+AD_EVENT_FLUSH_INTERVAL = 2.0  # Max seconds an event waits for its batch to fill
+
+
+class _FlushMarker(threading.Event):
+    """Queued by flush(); set once every item ahead of it has been written"""
+
+
+class BackgroundBatchWriter:
+    """Bounded in-memory queue drained in batches by a daemon writer thread"""
+    
+    def __init__(self, max_queue: int, batch_size: int, flush_interval: float, name: str):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+    
+    def submit(self, item, block: bool = False) -> bool:
+        """Queue an item; without `block`, drop it instead of waiting when the buffer is full"""
+        try:
+            self._queue.put(item, block=block)
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        
+        with self._lock:
+            self.submitted += 1
+        return True
+    
+    def _write_batch(self, batch: List) -> None:
+        raise NotImplementedError
+    
+    def _run(self):
+        while True:
+            try:
+                items = [self._queue.get(timeout=0.1 if self._stop.is_set() else 1.0)]
+            except queue.Empty:
+                if self._stop.is_set():
+                    return
+                continue
+            
+            # Keep collecting until the batch is full or flush_interval has passed
+            # since its first item. A flush marker or shutdown writes what is there.
+            deadline = time.monotonic() + self.flush_interval
+            flushes = [item for item in items if isinstance(item, _FlushMarker)]
+            while len(items) - len(flushes) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                draining = self._stop.is_set() or flushes or remaining <= 0
+                try:
+                    if draining:
+                        item = self._queue.get_nowait()
+                    else:
+                        # Short waits so close() is noticed promptly
+                        item = self._queue.get(timeout=min(remaining, 0.05))
+                except queue.Empty:
+                    if draining:
+                        break
+                    continue
+                items.append(item)
+                if isinstance(item, _FlushMarker):
+                    flushes.append(item)
+            
+            batch = [item for item in items if not isinstance(item, _FlushMarker)]
+            try:
+                if batch:
+                    self._write_batch(batch)
+                with self._lock:
+                    self.written += len(batch)
+            except Exception:
+                with self._lock:
+                    self.failed += len(batch)
+            finally:
+                for marker in flushes:
+                    marker.set()
+                for _ in items:
+                    self._queue.task_done()
+    
+    def flush(self) -> None:
+        """Block until everything queued before this call has been written"""
+        if not self._thread.is_alive():
+            return
+        # The marker queues behind earlier items and cuts the batching wait short,
+        # so concurrent flushes neither wait on later items nor on each other
+        marker = _FlushMarker()
+        self._queue.put(marker)
+        marker.wait()
+    
+    def close(self, timeout: float = 5.0) -> None:
+        """Drain the buffer and stop the writer thread"""
+        self._stop.set()
+        self._thread.join(timeout)
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "submitted": self.submitted,
+                "written": self.written,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "pending": self._queue.qsize(),
+            }
+
+
+class AdEventLog(BackgroundBatchWriter):
+    """Append-only JSONL log of ad impressions, written off the render path"""
+    
+    def __init__(self, path: str = AD_EVENT_LOG_PATH):
+        self.path = path
+        super().__init__(AD_EVENT_BUFFER_SIZE, AD_EVENT_BATCH_SIZE, AD_EVENT_FLUSH_INTERVAL, "ad-event-writer")
+    
+    def record(self, event_type: str, ad: Dict, session_id: str, turn: int, placement: str) -> bool:
+        """Record an ad event without ever waiting on I/O"""
+        return self.submit({
+            "event": event_type,
+            "ad_id": ad["id"],
+            "category": ad.get("category", "general"),
+            "placement": placement,
+            "session_id": session_id,
+            "turn": turn,
+            "ts": time.time(),
+        })
+    
+    def _write_batch(self, batch: List[Dict]) -> None:
+        lines = "".join(json.dumps(event, separators=(",", ":")) + "\n" for event in batch)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+
+@st.cache_resource
+def get_ad_event_log(path: str = AD_EVENT_LOG_PATH) -> AdEventLog:
+    """One ad event writer per process"""
+    return AdEventLog(path)
+
 
 class AdManager:
     """Manages contextual advertisements for the local guide"""
     
-    def __init__(self):
+    def __init__(self, catalogue: AdCatalogue, event_log: Optional[AdEventLog] = None, session_id: str = ""):
+        # The catalogue is shared; only pacing and frequency state is per session
+        self.catalogue = catalogue
+        self.event_log = event_log
+        self.session_id = session_id
         self.ad_counter = 0
-        self.sample_ads = {
-            "food": [
-                {
-                    "title": "🍕 Tony's Authentic Pizza",
-                    "description": "Fresh ingredients, wood-fired oven. Order online for 20% off!",
-                    "url": "https://example.com/tonys-pizza",
-                    "cta": "Order Now",
-                    "type": "restaurant"
-                },
-                {
-                    "title": "🥘 DoorDash - Food Delivery",
-                    "description": "Get your favorite local restaurants delivered. New users get $10 off!",
-                    "url": "https://doordash.com",
-                    "cta": "Get $10 Off",
-                    "type": "service"
-                },
-                {
-                    "title": "☕ Blue Bottle Coffee",
-                    "description": "Premium coffee beans delivered to your door. Free shipping on orders $40+",
-                    "url": "https://bluebottlecoffee.com",
-                    "cta": "Shop Coffee",
-                    "type": "product"
-                }
-            ],
-            "activities": [
-                {
-                    "title": "🎟️ GetYourGuide Tours",
-                    "description": "Skip-the-line tickets & unique experiences. Book now, cancel free!",
-                    "url": "https://getyourguide.com",
-                    "cta": "Book Tours",
-                    "type": "service"
-                },
-                {
-                    "title": "🏛️ Museum Pass",
-                    "description": "Access 60+ attractions with one pass. Save up to 50% on admissions!",
-                    "url": "https://example.com/museum-pass",
-                    "cta": "Get Pass",
-                    "type": "service"
-                },
-                {
-                    "title": "🚴 Bike Rental Co.",
-                    "description": "Explore the city on two wheels! Electric bikes available. Book online.",
-                    "url": "https://example.com/bike-rental",
-                    "cta": "Rent Bike",
-                    "type": "service"
-                }
-            ],
-            "accommodation": [
-                {
-                    "title": "🏨 Booking.com",
-                    "description": "Find the perfect stay. Free cancellation on most hotels!",
-                    "url": "https://booking.com",
-                    "cta": "Find Hotels",
-                    "type": "service"
-                },
-                {
-                    "title": "🏠 Airbnb",
-                    "description": "Unique stays and experiences. Get $40 off your first trip!",
-                    "url": "https://airbnb.com",
-                    "cta": "Get $40 Off",
-                    "type": "service"
-                }
-            ],
-            "general": [
-                {
-                    "title": "🧳 Travel Gear Store",
-                    "description": "Quality luggage, backpacks & travel accessories. Free shipping over $50!",
-                    "url": "https://example.com/travel-gear",
-                    "cta": "Shop Now",
-                    "type": "product"
-                },
-                {
-                    "title": "📱 Citymapper",
-                    "description": "Navigate like a local with real-time transit info. Download the app!",
-                    "url": "https://citymapper.com",
-                    "cta": "Download App",
-                    "type": "app"
-                },
-                {
-                    "title": "💳 Travel Rewards Card",
-                    "description": "Earn 2x points on travel & dining. No foreign transaction fees!",
-                    "url": "https://example.com/travel-card",
-                    "cta": "Apply Now",
-                    "type": "financial"
-                }
-            ]
-        }
+        self.impressions = {}
+        self._sidebar_ad = (None, None)
+        self._sidebar_logged_turn = None
+    
+    def record_impression(self, ad: Dict, placement: str) -> None:
+        """Queue an impression event; never blocks rendering"""
+        if self.event_log:
+            self.event_log.record("impression", ad, self.session_id, self.ad_counter, placement)
+    
+    def _pick(self, candidates) -> Optional[Dict]:
+        """Pick a random ad among candidates that are under the frequency cap"""
+        if len(candidates) <= AD_PICK_ATTEMPTS:
+            # Small pools (keyword matches) are filtered exactly
+            eligible = [ad for ad in candidates if self.impressions.get(ad["id"], 0) < AD_FREQUENCY_CAP]
+            ad = random.choice(eligible) if eligible else None
+        else:
+            # Large pools (whole categories) are sampled, so cost does not grow with the catalogue
+            ad = None
+            for _ in range(AD_PICK_ATTEMPTS):
+                candidate = candidates[random.randrange(len(candidates))]
+                if self.impressions.get(candidate["id"], 0) < AD_FREQUENCY_CAP:
+                    ad = candidate
+                    break
+        
+        if ad is not None:
+            self.impressions[ad["id"]] = self.impressions.get(ad["id"], 0) + 1
+        return ad
     
     def get_contextual_ad(self, conversation_context: str, category: str = "general") -> Optional[Dict]:
         """Get a contextual ad based on conversation topic"""
         
         # Don't show ads too frequently
         self.ad_counter += 1
-        if self.ad_counter % 4 != 0:  # Show ad every 4th interaction
+        if self.ad_counter % AD_PACING_INTERVAL != 0:
             return None
         
-        # Determine ad category from context
-        context_lower = conversation_context.lower()
+        # Prefer ads with the most keyword matches, stepping down when those are capped,
+        # then the requested category
+        scores = self.catalogue.match(conversation_context)
+        for best in sorted(set(scores.values()), reverse=True):
+            ad = self._pick([self.catalogue.by_id[ad_id] for ad_id, score in scores.items() if score == best])  # O(matched ads)
+            if ad:
+                return ad
         
-        if any(word in context_lower for word in ['restaurant', 'food', 'eat', 'coffee', 'dinner', 'lunch']):
-            category = "food"
-        elif any(word in context_lower for word in ['hotel', 'stay', 'accommodation', 'sleep']):
-            category = "accommodation"
-        elif any(word in context_lower for word in ['activity', 'museum', 'tour', 'attraction', 'visit']):
-            category = "activities"
-        else:
-            category = "general"
-        
-        # Get random ad from category
-        ads = self.sample_ads.get(category, self.sample_ads["general"])
-        return random.choice(ads) if ads else None
+        return self._pick(self.catalogue.in_category(category))
     
     def render_ad(self, ad: Dict) -> None:
         """Render an ad in the UI"""
         if not ad:
             return
         
+        self.record_impression(ad, "inline")
+        
         with st.container():
             st.markdown("---")
             
@@ -646,16 +1769,29 @@ class AdManager:
     
     def get_sidebar_ad(self) -> Optional[Dict]:
         """Get an ad for the sidebar"""
-        # Rotate through different categories for sidebar
-        categories = ["general", "food", "activities", "accommodation"]
-        category = categories[self.ad_counter % len(categories)]
+        # Keep the same sidebar ad across reruns until the next interaction
+        turn, ad = self._sidebar_ad
+        if turn == self.ad_counter:
+            return ad
         
-        ads = self.sample_ads.get(category, self.sample_ads["general"])
-        return random.choice(ads) if ads else None
+        # Rotate through different categories for sidebar
+        category = AD_CATEGORIES[self.ad_counter % len(AD_CATEGORIES)]
+        ad = self._pick(self.catalogue.in_category(category))
+        self._sidebar_ad = (self.ad_counter, ad)
+        return ad
+    
+    def sidebar_ad(self) -> Optional[Dict]:
+        """The sidebar ad for this rerun, recording its impression once per turn"""
+        ad = self.get_sidebar_ad()
+        # The sidebar ad is re-rendered on every rerun; count it once per turn
+        if ad and self._sidebar_logged_turn != self.ad_counter:
+            self._sidebar_logged_turn = self.ad_counter
+            self.record_impression(ad, "sidebar")
+        return ad
     
     def render_sidebar_ad(self) -> None:
         """Render a compact ad in the sidebar"""
-        ad = self.get_sidebar_ad()
+        ad = self.sidebar_ad()
         if not ad:
             return
         
@@ -676,6 +1812,401 @@ class AdManager:
             unsafe_allow_html=True
         )
 
+# Conversation storage configuration
+CONVERSATION_DB_PATH = os.environ.get("LOCAL_GUIDE_CONVERSATIONS_PATH", "conversations.db")
+HOT_WINDOW_MESSAGES = 20  # Messages kept in session state
+SESSION_MEMORY_CAP_BYTES = 64 * 1024  # Max serialized size of the hot window
+HISTORY_PAGE_SIZE = 20  # Older messages loaded per "Load earlier" click
+CONVERSATION_RETENTION_DAYS = 30
+COMPACTION_INTERVAL = 3600  # Seconds between compaction runs
+RESUME_COOKIE = "local_guide_resume"  # Holds the secret key a reload resumes from
+RESUME_KEY_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+class ConversationStore(BackgroundBatchWriter):
+    """SQLite (WAL) conversation history with batched appends from a writer thread"""
+    
+    def __init__(self, path: str = CONVERSATION_DB_PATH):
+        self.path = path
+        self._conn = None  # Owned by the writer thread
+        self._last_compaction = 0.0
+        self._compaction_lock = threading.Lock()
+        
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    session_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    message_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    PRIMARY KEY (session_id, seq)
+                );
+                CREATE TABLE IF NOT EXISTS sessions (
+                    session_id TEXT PRIMARY KEY,
+                    updated REAL NOT NULL,
+                    preferences TEXT
+                );
+                CREATE UNIQUE INDEX IF NOT EXISTS messages_id ON messages (session_id, message_id);
+                CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated);
+            """)
+            conn.commit()
+        finally:
+            conn.close()
+        
+        super().__init__(10000, 200, 0.5, "conversation-writer")
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+    
+    def append(self, session_id: str, message: Dict) -> None:
+        """Queue a message for writing, giving it an "id" if it has none; waits only if the write buffer is full"""
+        message.setdefault("id", uuid.uuid4().hex)
+        self.submit(("append", session_id, message), block=True)
+    
+    def clear(self, session_id: str) -> None:
+        """Queue deletion of a session's history, ordered after earlier appends"""
+        self.submit(("clear", session_id), block=True)
+    
+    def save_preferences(self, session_id: str, preferences: Dict) -> None:
+        """Queue a write of the session's preference profile"""
+        self.submit(("preferences", session_id, preferences), block=True)
+    
+    def load_preferences(self, session_id: str) -> Dict:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT preferences FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        finally:
+            conn.close()
+        return json.loads(row[0]) if row and row[0] else {}
+    
+    def _write_batch(self, batch: List) -> None:
+        if self._conn is None:
+            self._conn = self._connect()
+        
+        now = time.time()
+        with self._conn:
+            for item in batch:
+                if item[0] == "append":
+                    # The single writer thread assigns seq, so tabs sharing a session never collide
+                    _, session_id, message = item
+                    self._conn.execute(
+                        "INSERT INTO messages (session_id, seq, message_id, role, payload, created) "
+                        "SELECT ?, COALESCE(MAX(seq) + 1, 0), ?, ?, ?, ? FROM messages WHERE session_id = ?",
+                        (session_id, message["id"], message["role"], json.dumps(message), now, session_id)
+                    )
+                    self._conn.execute(
+                        "INSERT INTO sessions (session_id, updated) VALUES (?, ?) "
+                        "ON CONFLICT (session_id) DO UPDATE SET updated = excluded.updated",
+                        (session_id, now)
+                    )
+                elif item[0] == "preferences":
+                    _, session_id, preferences = item
+                    self._conn.execute(
+                        "INSERT INTO sessions (session_id, updated, preferences) VALUES (?, ?, ?) "
+                        "ON CONFLICT (session_id) DO UPDATE SET updated = excluded.updated, preferences = excluded.preferences",
+                        (session_id, now, json.dumps(preferences))
+                    )
+                else:
+                    self._conn.execute("DELETE FROM messages WHERE session_id = ?", (item[1],))
+                    self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (item[1],))
+    
+    def load_recent(self, session_id: str, limit: int) -> tuple:
+        """Return (last `limit` messages, total message count) for a session"""
+        self.flush()
+        conn = self._connect()
+        try:
+            total = conn.execute(
+                "SELECT COUNT(*) FROM messages WHERE session_id = ?", (session_id,)
+            ).fetchone()[0]
+            rows = conn.execute(
+                "SELECT payload FROM messages WHERE session_id = ? ORDER BY seq DESC LIMIT ?",
+                (session_id, limit)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [json.loads(row[0]) for row in reversed(rows)], total
+    
+    def load_earlier(self, session_id: str, before_id: str, limit: int) -> List[Dict]:
+        """Load up to `limit` messages stored before message `before_id`, oldest first.
+        
+        Paging from a message rather than from the newest row keeps other tabs'
+        later appends from shifting the page.
+        """
+        conn = self._connect()
+        try:
+            anchor = "SELECT seq FROM messages WHERE session_id = ? AND message_id = ?"
+            if conn.execute(anchor, (session_id, before_id)).fetchone() is None:
+                # Only a message appended moments ago can still be queued
+                self.flush()
+            rows = conn.execute(
+                f"SELECT payload FROM messages WHERE session_id = ? AND seq < ({anchor}) ORDER BY seq DESC LIMIT ?",
+                (session_id, session_id, before_id, limit)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [json.loads(row[0]) for row in reversed(rows)]
+    
+    def compact(self, max_age_days: int = CONVERSATION_RETENTION_DAYS) -> int:
+        """Delete sessions idle for longer than `max_age_days`; returns sessions removed"""
+        cutoff = time.time() - max_age_days * 86400
+        conn = self._connect()
+        try:
+            with conn:
+                stale = "SELECT session_id FROM sessions WHERE updated < ?"
+                conn.execute(f"DELETE FROM messages WHERE session_id IN ({stale})", (cutoff,))
+                removed = conn.execute("DELETE FROM sessions WHERE updated < ?", (cutoff,)).rowcount
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        finally:
+            conn.close()
+        return removed
+    
+    def maybe_compact(self) -> None:
+        """Run compaction in the background at most once per COMPACTION_INTERVAL"""
+        if time.time() - self._last_compaction < COMPACTION_INTERVAL:
+            return
+        if not self._compaction_lock.acquire(blocking=False):
+            return
+        self._last_compaction = time.time()
+        
+        def run():
+            try:
+                self.compact()
+            except sqlite3.Error:
+                pass
+            finally:
+                self._compaction_lock.release()
+        
+        threading.Thread(target=run, name="conversation-compaction", daemon=True).start()
+
+
+@st.cache_resource
+def get_conversation_store(path: str = CONVERSATION_DB_PATH) -> ConversationStore:
+    """One conversation store per process"""
+    return ConversationStore(path)
+
+
+def _set_resume_cookie(resume_key: str) -> None:
+    """Store the resume key in a first-party cookie via a zero-height component"""
+    max_age = CONVERSATION_RETENTION_DAYS * 86400
+    components.html(
+        "<script>"
+        f"window.parent.document.cookie = '{RESUME_COOKIE}={resume_key}; Max-Age={max_age}; Path=/; SameSite=Strict'"
+        " + (window.parent.location.protocol === 'https:' ? '; Secure' : '');"
+        "</script>",
+        height=0,
+    )
+
+
+def get_session_id() -> str:
+    """Stable session id derived from a secret resume key kept in a browser cookie.
+    
+    The key never appears in the URL, so sharing a link does not share the
+    conversation or preference profile. Only its hash is used as the session id
+    in storage and logs. Anyone who can read the browser's cookies can still
+    resume the session.
+    """
+    if 'session_id' not in st.session_state:
+        resume_key = st.context.cookies.get(RESUME_COOKIE, "")
+        if not RESUME_KEY_PATTERN.fullmatch(resume_key):
+            resume_key = secrets.token_hex(16)
+            _set_resume_cookie(resume_key)
+        # Links from older versions carried the id in ?sid=; drop it rather than honour it
+        if "sid" in st.query_params:
+            del st.query_params["sid"]
+        st.session_state.session_id = hashlib.sha256(resume_key.encode()).hexdigest()[:32]
+    return st.session_state.session_id
+
+
+def _messages_size(messages: List[Dict]) -> int:
+    return sum(len(json.dumps(message)) for message in messages)
+
+
+# The conversation helpers below take an optional `state` (default st.session_state)
+# so the benchmark can drive exactly the same turn logic without a Streamlit runtime.
+
+def append_message(store: ConversationStore, message: Dict, state=None) -> None:
+    """Persist a message and keep only a bounded hot window in session state"""
+    state = st.session_state if state is None else state
+    message.setdefault("index", state.message_count)  # Position in the conversation
+    store.append(state.session_id, message)
+    state.message_count += 1
+    
+    messages = state.messages
+    messages.append(message)
+    while len(messages) > 2 and (
+        len(messages) > HOT_WINDOW_MESSAGES or _messages_size(messages) > SESSION_MEMORY_CAP_BYTES
+    ):
+        messages.pop(0)
+
+
+def reset_conversation(store: ConversationStore, location: str, state=None) -> None:
+    """Start a fresh conversation with a welcome message"""
+    state = st.session_state if state is None else state
+    store.clear(state.session_id)
+    state.messages = []
+    state.message_count = 0
+    state.history_pages = 0
+    state.preferences = {}
+    welcome_msg = f"Hello! I'm your personal local guide for {location}. I can help you discover amazing restaurants, attractions, hidden gems, and everything you need to explore like a local! What would you like to find today? 🌟"
+    append_message(store, {"role": "assistant", "content": welcome_msg}, state)
+
+
+def init_conversation(store: ConversationStore, location: str, state=None) -> None:
+    """Resume the session's stored conversation into session state, or start a new one"""
+    state = st.session_state if state is None else state
+    messages, total = store.load_recent(state.session_id, HOT_WINDOW_MESSAGES)
+    state.messages = messages
+    state.message_count = total
+    state.history_pages = 0
+    state.preferences = store.load_preferences(state.session_id)
+    if not messages:
+        reset_conversation(store, location, state)
+
+
+def answer_query(guide: "LocalGuide", store: ConversationStore, ad_manager: AdManager, query: str,
+                 location: Location, state=None) -> Tuple[Dict, Optional[str], Optional[Dict]]:
+    """Run and record a chat turn; returns (assistant message, live map URL, contextual ad) to render"""
+    state = st.session_state if state is None else state
+    append_message(store, {"role": "user", "content": query}, state)
+    
+    attachments = map_url = None
+    # Check if we should get places data
+    if guide.is_location_query(query) and guide.gmaps_client:
+        places_data = guide.search_places_for_query(query, location, state.preferences)
+        
+        # Generate response from the same places shown on the map
+        response, preference_delta = guide.chat_with_guide(query, location, state.messages[:-1], places_data)
+        
+        # Keep the map with the message for replay; the live turn shows it by URL
+        # while the image is cached in the background
+        if places_data and hasattr(guide, 'maps_api_key'):
+            attachments = guide.build_place_attachments(places_data, location)
+            map_url = guide.generate_static_map(places_data, location)
+            guide.schedule_static_map(places_data, location)
+    else:
+        # Regular response without places data
+        response, preference_delta = guide.chat_with_guide(query, location, state.messages[:-1])
+    
+    contextual_ad = ad_manager.get_contextual_ad(query + " " + response)
+    
+    assistant_message = {"role": "assistant", "content": response}
+    if attachments:
+        assistant_message["attachments"] = attachments
+    append_message(store, assistant_message, state)
+    
+    # Fold preferences revealed this turn into the session profile
+    if preference_delta:
+        state.preferences = merge_preferences(state.preferences, preference_delta)
+        store.save_preferences(state.session_id, state.preferences)
+    
+    # Warm the recommendation buttons while the user reads the answer
+    if guide.gmaps_client and state.message_count > 4:
+        guide.prefetcher.schedule(state.session_id, guide, location)
+    
+    return assistant_message, map_url, contextual_ad
+
+
+def add_recommendations(guide: "LocalGuide", store: ConversationStore, ad_manager: AdManager, rec_type: str,
+                        location: Location, state=None) -> Tuple[Dict, Optional[Dict]]:
+    """Generate and record personalized recommendations; returns (message, contextual ad)"""
+    state = st.session_state if state is None else state
+    recommendations = guide.generate_personalized_recommendations(
+        location, state.messages, rec_type, state.preferences
+    )
+    contextual_ad = ad_manager.get_contextual_ad(recommendations, rec_type)
+    message = {
+        "role": "assistant",
+        "content": f"## 🤖 Personalized {rec_type.title()} Recommendations\n\n{recommendations}"
+    }
+    append_message(store, message, state)
+    return message, contextual_ad
+
+
+def add_itinerary(guide: "LocalGuide", store: ConversationStore, ad_manager: AdManager,
+                  location: Location, state=None) -> Tuple[Dict, Optional[Dict]]:
+    """Generate and record an itinerary; returns (message, contextual ad)"""
+    state = st.session_state if state is None else state
+    itinerary = guide.create_recommendation_itinerary(location, state.messages, preferences=state.preferences)
+    contextual_ad = ad_manager.get_contextual_ad(itinerary, "activities")
+    message = {"role": "assistant", "content": f"## 📅 Your Personalized Itinerary\n\n{itinerary}"}
+    append_message(store, message, state)
+    return message, contextual_ad
+
+
+def attachment_map(attachments: Dict, cache: Optional[Cache]):
+    """A message's cached map image, or None; never makes a request"""
+    if not cache or not attachments.get("map_key"):
+        return None
+    return cache.peek("static_map", attachments["map_key"])
+
+
+def render_place_attachments(attachments: Dict, cache: Optional[Cache], map_url: Optional[str] = None) -> None:
+    """Render a message's map and quick links from stored data, without external calls.
+    
+    The live turn passes `map_url` so the browser loads the map while the image
+    is cached in the background; replays only show what is already cached.
+    """
+    places = attachments.get("places", [])
+    if not places:
+        return
+    
+    st.markdown("---")
+    st.markdown("📍 **Locations on Map:**")
+    
+    # Only ever read from the cache; if the image has expired the links still show
+    map_image = attachment_map(attachments, cache)
+    if map_image or map_url:
+        st.image(map_image or map_url, caption="Map of recommended places")
+    
+    # Show place details with links
+    st.markdown("🔗 **Quick Access Links:**")
+    for i, place in enumerate(places):
+        col1, col2 = st.columns(2)
+        with col1:
+            st.markdown(f"**{chr(65+i)}. {place['name']}**")
+            st.markdown(f"⭐ {place.get('rating', 'N/A')} | {'💰' * (place.get('price_level', 1) if place.get('price_level', 1) != 'N/A' else 1)}")
+        with col2:
+            st.markdown(f"[📍 View on Maps]({place['maps_link']})")
+            if place.get('directions_link'):
+                st.markdown(f"[🚶 Get Directions]({place['directions_link']})")
+
+
+def render_message(message: Dict, cache: Optional[Cache]) -> None:
+    """Render a stored chat message with its attachments"""
+    with st.chat_message(message["role"]):
+        st.markdown(message["content"])
+        if message.get("attachments"):
+            render_place_attachments(message["attachments"], cache)
+
+
+def earlier_messages(store: ConversationStore, state=None) -> List[Dict]:
+    """Offloaded history for the pages the user has opened; reads nothing when none are"""
+    state = st.session_state if state is None else state
+    offloaded = state.message_count - len(state.messages)
+    shown = min(offloaded, state.history_pages * HISTORY_PAGE_SIZE)
+    if shown <= 0:
+        return []
+    # Read from disk on each rerun instead of holding older turns in memory
+    return store.load_earlier(state.session_id, state.messages[0]["id"], shown)
+
+
+def render_earlier_messages(store: ConversationStore, cache: Optional[Cache]) -> None:
+    """Lazily load and render history that has been offloaded from session state"""
+    offloaded = st.session_state.message_count - len(st.session_state.messages)
+    shown = min(offloaded, st.session_state.history_pages * HISTORY_PAGE_SIZE)
+    if shown < offloaded and st.button(f"⬆️ Load earlier messages ({offloaded - shown} more)"):
+        st.session_state.history_pages += 1
+    
+    for message in earlier_messages(store):
+        render_message(message, cache)
+
+
 def add_recommendations_sidebar(guide, ad_manager):
     """Add recommendation features to sidebar"""
     st.sidebar.markdown("---")
@@ -707,17 +2238,12 @@ def add_recommendations_sidebar(guide, ad_manager):
         # Preference display
         if st.sidebar.button("🔍 Show My Preferences", key="show_prefs"):
             with st.sidebar.expander("Your Detected Preferences"):
-                if messages_exist and guide.openai_client:
-                    try:
-                        preferences = guide.analyze_user_preferences(st.session_state.messages)
-                        if preferences:
-                            for key, value in preferences.items():
-                                if value and value != "unknown" and value != []:
-                                    st.write(f"**{key.replace('_', ' ').title()}:** {value}")
-                        else:
-                            st.write("Keep chatting to help me learn your preferences!")
-                    except Exception as e:
-                        st.write("Learning your preferences...")
+                # Collected from every chat reply, so no extra model call here
+                preferences = st.session_state.get('preferences', {})
+                if preferences:
+                    for key, value in preferences.items():
+                        if value and value != "unknown" and value != []:
+                            st.write(f"**{key.replace('_', ' ').title()}:** {value}")
                 else:
                     st.write("Keep chatting to help me learn your preferences!")
     else:
@@ -731,9 +2257,17 @@ def main():
     st.title("🗺️ AI Local Guide")
     st.markdown("*Ask me about local spots, restaurants, attractions, and travel tips for any city worldwide!*")
     
+    session_id = get_session_id()
+    store = get_conversation_store()
+    store.maybe_compact()
+    
     # Initialize ad manager
     if 'ad_manager' not in st.session_state:
-        st.session_state.ad_manager = AdManager()
+        st.session_state.ad_manager = AdManager(
+            load_ad_catalogue(),
+            event_log=get_ad_event_log(),
+            session_id=session_id
+        )
     ad_manager = st.session_state.ad_manager
     
     # Sidebar for configuration
@@ -756,8 +2290,12 @@ def main():
         )
         
         # Initialize the guide with API keys
-        guide = LocalGuide()
+        guide = LocalGuide(usage_stats=get_prompt_cache_stats())
         guide.setup_apis(openai_key, gmaps_key)
+        guide.prefetcher = get_places_prefetcher()
+        guide.map_downloader = get_map_downloader()
+        guide.cache = get_cache()
+        guide.session_id = session_id
         
         st.markdown("---")
         
@@ -771,10 +2309,12 @@ def main():
         
         # Check for geolocation data in session state
         if 'user_lat' in st.session_state and 'user_lng' in st.session_state:
+            # The address is for display only; searches use the coordinates
             user_location = guide.reverse_geocode(st.session_state.user_lat, st.session_state.user_lng)
             st.success(f"📍 Found: {user_location}")
             if st.button("Use This Location"):
                 st.session_state.location = user_location
+                st.session_state.location_coords = (user_location, st.session_state.user_lat, st.session_state.user_lng)
                 location = user_location
         
         st.markdown("---")
@@ -802,18 +2342,17 @@ def main():
     # Store location in session state
     if location:
         st.session_state['location'] = location
+    current_location = get_current_location()
+    guide.prefetcher.invalidate(session_id, current_location)
     
-    # Initialize chat history
+    # Initialize chat history, resuming a stored conversation if there is one
     if "messages" not in st.session_state:
-        st.session_state.messages = []
-        # Add welcome message
-        welcome_msg = f"Hello! I'm your personal local guide for {location}. I can help you discover amazing restaurants, attractions, hidden gems, and everything you need to explore like a local! What would you like to find today? 🌟"
-        st.session_state.messages.append({"role": "assistant", "content": welcome_msg})
+        init_conversation(store, location)
     
     # Display chat messages
+    render_earlier_messages(store, guide.cache)
     for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+        render_message(message, guide.cache)
     
     # Handle suggested queries
     if "suggested_query" in st.session_state:
@@ -830,24 +2369,12 @@ def main():
         
         with st.chat_message("assistant"):
             with st.spinner(f"Generating personalized {rec_type} recommendations..."):
-                current_location = st.session_state.get('location', 'Current location')
-                recommendations = guide.generate_personalized_recommendations(
-                    current_location, 
-                    st.session_state.messages, 
-                    rec_type
-                )
-                st.markdown(f"## 🤖 Personalized {rec_type.title()} Recommendations\n\n{recommendations}")
-                
-                # Show contextual ad after recommendations
-                contextual_ad = ad_manager.get_contextual_ad(recommendations, rec_type)
-                if contextual_ad:
-                    ad_manager.render_ad(contextual_ad)
-        
-        # Add to chat history
-        st.session_state.messages.append({
-            "role": "assistant", 
-            "content": f"## 🤖 Personalized {rec_type.title()} Recommendations\n\n{recommendations}"
-        })
+                message, contextual_ad = add_recommendations(guide, store, ad_manager, rec_type, current_location)
+            st.markdown(message["content"])
+            
+            # Show contextual ad after recommendations
+            if contextual_ad:
+                ad_manager.render_ad(contextual_ad)
         st.rerun()
 
     # Handle itinerary generation
@@ -856,91 +2383,57 @@ def main():
         
         with st.chat_message("assistant"):
             with st.spinner("Creating your personalized itinerary..."):
-                current_location = st.session_state.get('location', 'Current location')
-                itinerary = guide.create_recommendation_itinerary(
-                    current_location, 
-                    st.session_state.messages
-                )
-                st.markdown(f"## 📅 Your Personalized Itinerary\n\n{itinerary}")
-                
-                # Show contextual ad after itinerary
-                contextual_ad = ad_manager.get_contextual_ad(itinerary, "activities")
-                if contextual_ad:
-                    ad_manager.render_ad(contextual_ad)
-        
-        # Add to chat history
-        st.session_state.messages.append({
-            "role": "assistant", 
-            "content": f"## 📅 Your Personalized Itinerary\n\n{itinerary}"
-        })
+                message, contextual_ad = add_itinerary(guide, store, ad_manager, current_location)
+            st.markdown(message["content"])
+            
+            # Show contextual ad after itinerary
+            if contextual_ad:
+                ad_manager.render_ad(contextual_ad)
         st.rerun()
     
     if query:
-        # Add user message to chat history
-        st.session_state.messages.append({"role": "user", "content": query})
         with st.chat_message("user"):
             st.markdown(query)
         
         # Generate assistant response
         with st.chat_message("assistant"):
             with st.spinner("Searching for the best local spots..."):
-                # Get location for search
-                current_location = st.session_state.get('location', 'Current location')
-                
-                # Check if we should get places data
-                if guide.is_location_query(query) and guide.gmaps_client:
-                    search_keywords = guide.extract_search_keywords(query)
-                    places_data = guide.get_nearby_places(current_location, search_keywords)
-                    
-                    # Generate response
-                    response = guide.chat_with_guide(query, current_location, st.session_state.messages[:-1])
-                    st.markdown(response)
-                    
-                    # Show map if places found
-                    if places_data and hasattr(guide, 'maps_api_key'):
-                        st.markdown("---")
-                        st.markdown("📍 **Locations on Map:**")
-                        
-                        map_url = guide.generate_static_map(places_data, current_location)
-                        if map_url:
-                            st.image(map_url, caption="Map of recommended places")
-                        
-                        # Show place details with links
-                        st.markdown("🔗 **Quick Access Links:**")
-                        for i, place in enumerate(places_data):
-                            col1, col2 = st.columns(2)
-                            with col1:
-                                st.markdown(f"**{chr(65+i)}. {place['name']}**")
-                                st.markdown(f"⭐ {place.get('rating', 'N/A')} | {'💰' * (place.get('price_level', 1) if place.get('price_level', 1) != 'N/A' else 1)}")
-                            with col2:
-                                st.markdown(f"[📍 View on Maps]({place['maps_link']})")
-                                if place.get('directions_link'):
-                                    st.markdown(f"[🚶 Get Directions]({place['directions_link']})")
-                    
-                    # Show contextual ad after place recommendations
-                    contextual_ad = ad_manager.get_contextual_ad(query + " " + response)
-                    if contextual_ad:
-                        ad_manager.render_ad(contextual_ad)
-                        
-                else:
-                    # Regular response without places data
-                    response = guide.chat_with_guide(query, current_location, st.session_state.messages[:-1])
-                    st.markdown(response)
-                    
-                    # Show contextual ad after regular responses (less frequently)
-                    contextual_ad = ad_manager.get_contextual_ad(query + " " + response)
-                    if contextual_ad:
-                        ad_manager.render_ad(contextual_ad)
-        
-        # Add assistant response to chat history
-        st.session_state.messages.append({"role": "assistant", "content": response})
+                message, map_url, contextual_ad = answer_query(guide, store, ad_manager, query, current_location)
+            st.markdown(message["content"])
+            
+            # Show map and links if places were found
+            if message.get("attachments"):
+                render_place_attachments(message["attachments"], guide.cache, map_url)
+            
+            # Show contextual ad after the response
+            if contextual_ad:
+                ad_manager.render_ad(contextual_ad)
     
     # Clear chat button
     if st.sidebar.button("🗑️ Clear Chat"):
-        st.session_state.messages = []
-        welcome_msg = f"Hello! I'm your personal local guide for {st.session_state.get('location', 'your area')}. I can help you discover amazing restaurants, attractions, hidden gems, and everything you need to explore like a local! What would you like to find today? 🌟"
-        st.session_state.messages.append({"role": "assistant", "content": welcome_msg})
+        reset_conversation(store, st.session_state.get('location', 'your area'))
         st.rerun()
+    
+    # Prompt caching effectiveness across all sessions in this process
+    with st.sidebar.expander("📊 Performance Stats"):
+        prefetch_stats = guide.prefetcher.stats()
+        st.write(f"**Prefetch:** {prefetch_stats['hit_rate']:.0%} hit rate "
+                 f"({prefetch_stats['hits']} hits, {prefetch_stats['misses']} misses, "
+                 f"{prefetch_stats['cancelled']} cancelled)")
+        
+        for namespace, stats in guide.cache.stats().items():
+            st.write(f"**Cache {namespace}:** {stats['hit_rate']:.0%} hit rate "
+                     f"({stats['hits']} hits, {stats['waits']} shared, {stats['misses']} misses)")
+        
+        cache_summary = guide.usage_stats.summary()
+        if cache_summary:
+            for name, stats in cache_summary.items():
+                st.write(f"**{name.title()}:** {stats['calls']} calls, "
+                         f"{stats['hit_rate']:.0%} cache hits, "
+                         f"{stats['cached_token_share']:.0%} cached tokens, "
+                         f"~${stats['estimated_savings_usd']:.4f} saved")
+        else:
+            st.write("No completions yet.")
 
 if __name__ == "__main__":
     main()